@@ -0,0 +1,616 @@
+"""
+Benchmark: handle_link ni lokal soxta Instagram/CDN va Bot API serverlari bilan yuklash
+
+    python bench.py --mix mixed --jobs 200 --rate 5
+    DOWNLOAD_CONCURRENCY=8 OVERSIZE_MODE=split python bench.py --mix reel --json run.json
+
+Bot sozlamalari odatdagidek env orqali beriladi, natijalarni --json bilan saqlab
+run'lar orasida solishtirish mumkin. Haqiqiy Instagram va Telegram'ga so'rov ketmaydi.
+
+Instagram qismi MediaDescriptor chegarasida almashtiriladi: load_post / load_story_reel
+soxta serverdan JSON oladi va describe_post / describe_story_item orqali o'tadi
+(Instaloader ichki GraphQL doc_id lari har versiyada o'zgaradi). Profil -> userid
+so'rovi simulyatsiya qilinmaydi.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+IG_PORT = 18710
+BOT_PORT = 18711
+TOKEN = "123456:bench"
+
+MIXES = {
+    "photo": {"photo": 1},
+    "carousel": {"carousel": 1},
+    "reel": {"reel": 1},
+    "story": {"story": 1},
+    "burst": {"burst": 1},
+    "multi": {"multi": 1},
+    "mixed": {"photo": 4, "carousel": 2, "reel": 1, "story": 2, "burst": 1, "multi": 1},
+}
+
+
+# ================= FAKE INSTAGRAM / CDN =================
+def make_media(root: Path, args):
+    """CDN fayllari: rasm, kichik video va katta reel"""
+    files = {
+        "photo.jpg": os.urandom(args.photo_kb * 1024),
+        "clip.mp4": os.urandom(args.clip_mb * 1024 * 1024),
+    }
+    for name, data in files.items():
+        (root / name).write_bytes(data)
+
+    reel = root / "reel.mp4"
+    size = args.reel_mb * 1024 * 1024
+    # Haqiqiy video bo'lsa compress / split yo'li ham o'lchanadi
+    if not args.fake_video:
+        bitrate = size * 8 // args.reel_seconds
+        try:
+            subprocess.run(
+                [
+                    "ffmpeg", "-y", "-loglevel", "error",
+                    "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={args.reel_seconds}",
+                    "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                    "-b:v", str(bitrate), "-minrate", str(bitrate), "-maxrate", str(bitrate),
+                    "-bufsize", str(bitrate), "-x264-params", "nal-hrd=cbr",
+                    "-movflags", "+faststart", str(reel),
+                ],
+                check=True,
+            )
+            return
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Reel generation failed ({e}), using random bytes")
+    reel.write_bytes(os.urandom(size))
+
+
+def catalogue(args):
+    """Shortcode / username -> soxta Instagram javobi"""
+    base = f"http://127.0.0.1:{IG_PORT}/cdn"
+    posts = {}
+    stories = {}
+
+    for i in range(args.unique):
+        posts[f"Ph{i}"] = {
+            "caption": f"photo {i} #bench", "mediacount": 1, "is_video": False,
+            "url": f"{base}/photo.jpg?p=Ph{i}",
+        }
+        posts[f"Re{i}"] = {
+            "caption": f"reel {i}", "mediacount": 1, "is_video": True,
+            "video_url": f"{base}/reel.mp4?p=Re{i}", "video_duration": float(args.reel_seconds),
+        }
+        nodes = []
+        for n in range(args.carousel_items):
+            if n % 4 == 3:
+                nodes.append({"is_video": True, "video_url": f"{base}/clip.mp4?p=Ca{i}_{n}"})
+            else:
+                nodes.append({"is_video": False, "display_url": f"{base}/photo.jpg?p=Ca{i}_{n}"})
+        posts[f"Ca{i}"] = {"caption": f"carousel {i}", "mediacount": len(nodes), "nodes": nodes}
+
+        expires = time.time() + 86400
+        stories[1000 + i] = [
+            {
+                "mediaid": (1000 + i) * 100 + n, "is_video": n == 0, "expiring_utc": expires,
+                "video_url": f"{base}/clip.mp4?s={i}_{n}", "url": f"{base}/photo.jpg?s={i}_{n}",
+            }
+            for n in range(3)
+        ]
+
+    return posts, stories
+
+
+async def serve_cdn(request):
+    """Range, HEAD, birinchi bayt kechikishi va tezlik cheklovi bilan"""
+    args = request.app["args"]
+    path = request.app["root"] / request.match_info["name"]
+    if not path.exists():
+        raise web.HTTPNotFound()
+    size = path.stat().st_size
+    headers = {"Accept-Ranges": "bytes", "Content-Type": "application/octet-stream"}
+
+    if request.method == "HEAD":
+        return web.Response(headers={**headers, "Content-Length": str(size)})
+
+    start, end, status = 0, size - 1, 200
+    if "Range" in request.headers:
+        first, _, last = request.headers["Range"].removeprefix("bytes=").partition("-")
+        start, end, status = int(first), min(int(last) if last else size - 1, size - 1), 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    await asyncio.sleep(args.cdn_latency / 1000)
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+
+    chunk = 256 * 1024
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = end - start + 1
+        while left > 0:
+            data = f.read(min(chunk, left))
+            left -= len(data)
+            await response.write(data)
+            if args.cdn_mbit:
+                await asyncio.sleep(len(data) * 8 / (args.cdn_mbit * 1_000_000))
+    return response
+
+
+async def serve_post(request):
+    await asyncio.sleep(request.app["args"].ig_latency / 1000)
+    post = request.app["posts"].get(request.match_info["shortcode"])
+    if post is None:
+        raise web.HTTPNotFound()
+    return web.json_response(post)
+
+
+async def serve_stories(request):
+    await asyncio.sleep(request.app["args"].ig_latency / 1000)
+    return web.json_response(request.app["stories"].get(int(request.match_info["userid"]), []))
+
+
+# ================= FAKE BOT API =================
+class FakeTelegram:
+    """Bot API ning bot ishlatadigan metodlari; natijalar chat bo'yicha yoziladi"""
+
+    GROUP_LIMIT = 10
+
+    def __init__(self, args):
+        self.args = args
+        self.message_id = 0
+        self.file_id = 0
+        self.session = None
+        self.uploaded = 0
+        self.fetched = 0
+        self.local = 0
+
+    def message(self, chat_id, **extra):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    async def media(self, kind: str, value, uploads: dict):
+        """Bitta media: attach (yuklangan), URL (Telegram o'zi oladi) yoki file_id"""
+        if isinstance(value, str) and value.startswith("attach://"):
+            value = uploads[value.removeprefix("attach://")]
+        if isinstance(value, bytes):
+            self.uploaded += len(value)
+            if self.args.upload_mbit:
+                await asyncio.sleep(len(value) * 8 / (self.args.upload_mbit * 1_000_000))
+        elif value.startswith("http"):
+            async with self.session.get(value) as response:
+                self.fetched += len(await response.read())
+        elif value.startswith("file://"):
+            # Lokal Bot API server faylni diskdan o'zi o'qiydi
+            self.local += os.path.getsize(value.removeprefix("file://"))
+
+        self.file_id += 1
+        file_id = value if isinstance(value, str) and not value.startswith("http") else f"F{self.file_id}"
+        ref = {"file_id": file_id, "file_unique_id": f"U{self.file_id}", "width": 720, "height": 720}
+        if kind == "video":
+            return {"video": {**ref, "duration": 1}}
+        return {"photo": [ref]}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        fields = {}
+        uploads = {}
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                uploads[key] = value.file.read()
+            else:
+                fields[key] = value
+        chat_id = fields.get("chat_id", 0)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self.message(chat_id, text=fields.get("text", ""))
+            request.app["outcomes"].setdefault(int(chat_id), []).append(("text", fields.get("text", "")))
+        elif method in ("deleteMessage", "sendChatAction"):
+            result = True
+        elif method in ("sendPhoto", "sendVideo"):
+            kind = "photo" if method == "sendPhoto" else "video"
+            value = uploads.get(kind, fields.get(kind))
+            result = self.message(chat_id, **await self.media(kind, value, uploads))
+            request.app["outcomes"].setdefault(int(chat_id), []).append(("media", 1))
+        elif method == "sendMediaGroup":
+            group = json.loads(fields["media"])
+            if not 2 <= len(group) <= self.GROUP_LIMIT:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: wrong media group size"})
+            result = [
+                self.message(chat_id, **await self.media(item["type"], item["media"], uploads))
+                for item in group
+            ]
+            request.app["outcomes"].setdefault(int(chat_id), []).append(("media", len(group)))
+        else:
+            return web.json_response({"ok": False, "error_code": 400, "description": f"{method} not faked"})
+
+        return web.json_response({"ok": True, "result": result})
+
+
+async def serve_outcomes(request):
+    return web.json_response({
+        "outcomes": {str(k): v for k, v in request.app["outcomes"].items()},
+        "uploaded": request.app["telegram"].uploaded,
+        "fetched": request.app["telegram"].fetched,
+        "local": request.app["telegram"].local,
+    })
+
+
+async def run_servers(args, root: Path, ready):
+    posts, stories = catalogue(args)
+
+    ig = web.Application()
+    ig.update(args=args, root=root, posts=posts, stories=stories)
+    ig.router.add_route("*", "/cdn/{name}", serve_cdn)
+    ig.router.add_get("/post/{shortcode}", serve_post)
+    ig.router.add_get("/stories/{userid}", serve_stories)
+
+    telegram = FakeTelegram(args)
+    telegram.session = aiohttp.ClientSession()
+    tg = web.Application(client_max_size=2 * 1024 ** 3)
+    tg.update(outcomes={}, telegram=telegram)
+    tg.router.add_post("/bot{token}/{method}", telegram.handle)
+    tg.router.add_get("/outcomes", serve_outcomes)
+
+    runners = []
+    for app, port in ((ig, IG_PORT), (tg, BOT_PORT)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    ready.set()
+    await asyncio.Event().wait()
+
+
+def server_main(args, root: str, ready):
+    """Soxta serverlar alohida protsessda - botning CPU si aralashmaydi"""
+    try:
+        asyncio.run(run_servers(args, Path(root), ready))
+    except KeyboardInterrupt:
+        pass
+
+
+# ================= DRIVER =================
+def setup_bot(workdir: Path):
+    """bot.py ni vaqtinchalik papkada, lokal serverlarga ulangan holda import qilish"""
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "INSTAGRAM_USERNAME": "",
+        "INSTAGRAM_ACCOUNTS": "",
+        "CACHE_DB": str(workdir / "cache.db"),
+        "MEDIA_CACHE_DIR": str(workdir / "media_cache"),
+        "SESSIONS_DIR": str(workdir / "sessions"),
+        # yt-dlp haqiqiy Instagram'ga boradi - faqat soxta load_post
+        "EXTRACTORS": "instaloader",
+    })
+    # Instagram rate limit simulyatsiya qilinmaydi
+    os.environ.setdefault("IG_RATE", "1000")
+    os.environ.setdefault("IG_RATE_MAX", "1000")
+    os.environ.setdefault("IG_RATE_BURST", "1000")
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    os.chdir(workdir)
+    import bot
+    import requests
+    import instaloader
+
+    ig = f"http://127.0.0.1:{IG_PORT}"
+
+    def get_json(path: str):
+        response = requests.get(f"{ig}/{path}", timeout=30)
+        if response.status_code == 404:
+            raise instaloader.exceptions.QueryReturnedNotFoundException(path)
+        response.raise_for_status()
+        return response.json()
+
+    # ACCOUNTS.run orqali chaqiriladi - rate limiter va akkaunt tanlash o'lchovga kiradi
+    def load_post(loader, shortcode: str):
+        data = get_json(f"post/{shortcode}")
+        nodes = [SimpleNamespace(**node) for node in data.pop("nodes", [])]
+        post = SimpleNamespace(
+            get_sidecar_nodes=lambda: iter(nodes),
+            **{"video_url": None, "video_duration": None, "url": None, **data},
+        )
+        return bot.describe_post(post, shortcode)
+
+    def load_story_reel(loader, userid: int):
+        data = get_json(f"stories/{userid}")
+        items = []
+        for story in data:
+            expires = story["expiring_utc"]
+            # Instaloader kabi naive UTC datetime
+            story["expiring_utc"] = datetime.fromtimestamp(expires, timezone.utc).replace(tzinfo=None)
+            items.append((str(story["mediaid"]), expires, bot.describe_story_item(SimpleNamespace(**story))))
+        return items
+
+    bot.load_post = load_post
+    bot.load_story_reel = load_story_reel
+    # Soxta server storylar uchun login so'ramaydi
+    bot.ACCOUNTS.accounts[0].logged_in = True
+    return bot
+
+
+class FfmpegMemory:
+    """
+    ffmpeg/ffprobe jarayonlarining eng katta RSS i
+
+    RUSAGE_CHILDREN.ru_maxrss fork qilingan bolaning exec dan oldingi (bot) xotirasini ham
+    o'z ichiga oladi, shuning uchun har bir jarayonning /proc/<pid>/status VmHWM qiymati
+    u tirikligida o'qiladi (faqat Linux; juda qisqa jarayonlar o'tkazib yuborilishi mumkin)
+    """
+
+    def __init__(self, transcoder):
+        self.peak_kb = 0
+        self.processes = 0
+        self.live = set()
+        spawn = transcoder._spawn
+
+        async def tracked(cmd, **kwargs):
+            process = await spawn(cmd, **kwargs)
+            self.processes += 1
+            self.live.add(process.pid)
+            return process
+
+        transcoder._spawn = tracked
+
+    def sample(self):
+        for pid in list(self.live):
+            try:
+                status = Path(f"/proc/{pid}/status").read_text()
+            except OSError:
+                self.live.discard(pid)
+                continue
+            hwm = [line for line in status.splitlines() if line.startswith("VmHWM:")]
+            if not hwm:
+                # Tugagan (zombie)
+                self.live.discard(pid)
+                continue
+            self.peak_kb = max(self.peak_kb, int(hwm[0].split()[1]))
+
+    async def run(self, interval: float = 0.05):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+    def peak_mb(self):
+        """MB, yoki None (ffmpeg ishlamadi yoki /proc yo'q)"""
+        return self.peak_kb / 1024 if self.peak_kb else None
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def make_links(args):
+    """[(link, chat soni)] - burst bir linkni bir vaqtda ko'p chatdan yuboradi"""
+    rng = random.Random(args.seed)
+    weights = MIXES[args.mix]
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.jobs)
+    used = []
+    links = []
+
+    for n, kind in enumerate(kinds):
+        i = n % args.unique
+        if used and rng.random() < args.repeat:
+            links.append((rng.choice(used), 1))
+            continue
+        if kind == "photo":
+            link = f"https://www.instagram.com/p/Ph{i}/"
+        elif kind == "carousel":
+            link = f"https://www.instagram.com/p/Ca{i}/"
+        elif kind == "reel":
+            link = f"https://www.instagram.com/reel/Re{i}/"
+        elif kind == "story":
+            link = f"https://www.instagram.com/stories/user{i}/{(1000 + i) * 100 + rng.randrange(3)}/"
+        elif kind == "multi":
+            # Bitta xabarda bir nechta link
+            codes = rng.sample([f"Ph{j}" for j in range(args.unique)] + [f"Ca{j}" for j in range(args.unique)],
+                               min(args.links_per_message, 2 * args.unique))
+            link = "\n".join(f"https://www.instagram.com/p/{code}/" for code in codes)
+        else:
+            link = f"https://www.instagram.com/p/Ph{i}/"
+            links.append((link, args.burst))
+            used.append(link)
+            continue
+        links.append((link, 1))
+        used.append(link)
+
+    return links
+
+
+async def drive(bot, args):
+    from telegram import Bot, Update
+
+    # handle_link dagi story username -> userid so'rovi o'rniga
+    for i in range(args.unique):
+        bot.STORY_CACHE.set_userid(f"user{i}", 1000 + i)
+
+    await bot.HTTP.start()
+    bot.PIPELINE.start()
+    bot.LOOP_MONITOR.start()
+    ffmpeg = FfmpegMemory(bot.TRANSCODER)
+    sampler = asyncio.create_task(ffmpeg.run())
+
+    latencies = []
+    chat_ids = []
+
+    # BOT_API_URL berilsa lokal server rejimi (file:// yo'llar) o'lchanadi
+    async with Bot(TOKEN, base_url=f"http://127.0.0.1:{BOT_PORT}/bot", local_mode=bot.LOCAL_BOT_API) as tg:
+        async def job(chat_id: int, link: str):
+            update = Update.de_json({
+                "update_id": chat_id,
+                "message": {
+                    "message_id": chat_id, "date": int(time.time()), "text": link,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+                },
+            }, tg)
+            started = time.perf_counter()
+            await bot.handle_link(update, None)
+            latencies.append(time.perf_counter() - started)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.perf_counter()
+        tasks = []
+        chat_id = 0
+
+        for link, copies in make_links(args):
+            for _ in range(copies):
+                chat_id += 1
+                chat_ids.append(chat_id)
+                tasks.append(asyncio.create_task(job(chat_id, link)))
+            if args.rate:
+                await asyncio.sleep(random.expovariate(args.rate))
+
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        session = await bot.HTTP.get()
+        async with session.get(f"http://127.0.0.1:{BOT_PORT}/outcomes") as response:
+            server = await response.json()
+
+    sampler.cancel()
+    await bot.LOOP_MONITOR.stop()
+    await bot.PIPELINE.stop()
+    await bot.HTTP.close()
+
+    ok = sum(
+        1 for c in chat_ids
+        if any(kind == "media" for kind, _ in server["outcomes"].get(str(c), []))
+    )
+    return {
+        "mix": args.mix,
+        "jobs": len(chat_ids),
+        "ok": ok,
+        "failed": len(chat_ids) - ok,
+        "wall_s": wall,
+        "jobs_per_s": len(chat_ids) / wall if wall else 0.0,
+        "latency_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=0.0),
+        },
+        "cpu_s": {
+            "bot": (after.ru_utime + after.ru_stime) - (usage.ru_utime + usage.ru_stime),
+            "ffmpeg": (after_children.ru_utime + after_children.ru_stime)
+                      - (children.ru_utime + children.ru_stime),
+        },
+        "peak_rss_mb": {
+            "bot": after.ru_maxrss / 1024,
+            "ffmpeg": ffmpeg.peak_mb(),
+        },
+        "ffmpeg_processes": ffmpeg.processes,
+        "bytes": {
+            "uploaded": server["uploaded"],
+            "fetched_by_telegram": server["fetched"],
+            "local_paths": server["local"],
+        },
+        "stages": bot.METRICS.summary("stage_seconds"),
+        "stage_wait": bot.METRICS.summary("stage_wait_seconds"),
+        "stats": bot.collect_stats(),
+    }
+
+
+def report(result: dict):
+    latency = result["latency_s"]
+    ffmpeg_rss = result["peak_rss_mb"]["ffmpeg"]
+    ffmpeg_rss = f"{ffmpeg_rss:.0f}MB" if ffmpeg_rss is not None else "n/a"
+    print(
+        f"\n{result['mix']}: {result['jobs']} jobs, {result['ok']} ok, {result['failed']} failed\n"
+        f"  throughput  {result['jobs_per_s']:.2f} jobs/s ({result['wall_s']:.1f}s)\n"
+        f"  latency     p50 {latency['p50']:.2f}s  p95 {latency['p95']:.2f}s  "
+        f"p99 {latency['p99']:.2f}s  max {latency['max']:.2f}s\n"
+        f"  cpu         bot {result['cpu_s']['bot']:.1f}s  ffmpeg {result['cpu_s']['ffmpeg']:.1f}s\n"
+        f"  peak rss    bot {result['peak_rss_mb']['bot']:.0f}MB  ffmpeg {ffmpeg_rss}"
+        f" ({result['ffmpeg_processes']} procs)\n"
+        f"  uploaded    {result['bytes']['uploaded'] / 1048576:.1f}MB "
+        f"(+{result['bytes']['fetched_by_telegram'] / 1048576:.1f}MB by URL, "
+        f"{result['bytes']['local_paths'] / 1048576:.1f}MB by local path)"
+    )
+    for stage, s in result["stages"].items():
+        print(f"  {stage:<12}{s['count']:>6}  avg {s['avg']:.2f}s  p95 <= {s['p95']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="eclipse-core benchmark (soxta Instagram va Bot API)")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=5.0, help="so'rov/s (0 = hammasi birdan)")
+    parser.add_argument("--unique", type=int, default=50, help="har turdagi turli postlar soni")
+    parser.add_argument("--repeat", type=float, default=0.0, help="oldingi linkni qayta yuborish ehtimoli")
+    parser.add_argument("--burst", type=int, default=10, help="burst: bitta link nechta chatdan")
+    parser.add_argument("--carousel-items", type=int, default=10)
+    parser.add_argument("--links-per-message", type=int, default=5, help="multi: bitta xabardagi linklar")
+    parser.add_argument("--photo-kb", type=int, default=300)
+    parser.add_argument("--clip-mb", type=int, default=4)
+    parser.add_argument("--reel-mb", type=int, default=60)
+    parser.add_argument("--reel-seconds", type=int, default=30)
+    parser.add_argument("--fake-video", action="store_true", help="reel uchun ffmpeg o'rniga tasodifiy baytlar")
+    parser.add_argument("--ig-latency", type=float, default=300, help="metadata javobi, ms")
+    parser.add_argument("--cdn-latency", type=float, default=50, help="birinchi bayt, ms")
+    parser.add_argument("--cdn-mbit", type=float, default=0, help="har bir ulanish tezligi (0 = cheklanmagan)")
+    parser.add_argument("--upload-mbit", type=float, default=0, help="Bot API ga yuklash tezligi")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="kesh va DB papkasi (default: vaqtinchalik, har safar bo'sh)")
+    parser.add_argument("--json", help="natijani faylga yozish")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as tmp:
+        media_root = Path(tmp) / "cdn"
+        media_root.mkdir()
+        workdir = Path(args.workdir).resolve() if args.workdir else Path(tmp) / "work"
+        workdir.mkdir(parents=True, exist_ok=True)
+        make_media(media_root, args)
+
+        context = multiprocessing.get_context("spawn")
+        ready = context.Event()
+        server = context.Process(target=server_main, args=(args, str(media_root), ready), daemon=True)
+        server.start()
+        if not ready.wait(30):
+            raise RuntimeError("fake servers did not start")
+
+        cwd = os.getcwd()
+        try:
+            bot = setup_bot(workdir)
+            result = asyncio.run(drive(bot, args))
+        finally:
+            server.terminate()
+            server.join()
+            os.chdir(cwd)
+
+    report(result)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
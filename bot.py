@@ -1,9 +1,28 @@
 import os
 import re
+import json
+import bisect
+import hashlib
+import math
+import time
+import random
 import asyncio
+import shutil
+import sqlite3
+import threading
 import aiohttp
+from aiohttp import web
+import signal
 import subprocess
+import multiprocessing
 from pathlib import Path
+from datetime import timezone
+from collections import deque, OrderedDict
+from functools import partial, cache
+from dataclasses import dataclass, asdict
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager, AsyncExitStack
 from tempfile import TemporaryDirectory
 import instaloader
 from dotenv import load_dotenv
@@ -13,72 +32,220 @@ try:
 except ImportError:
     browser_cookie3 = None
 
-from telegram import Update, InputMediaPhoto, InputMediaVideo
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+from telegram import Bot, Update, InputMediaPhoto, InputMediaVideo
+from telegram.error import TelegramError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
 # ================= CONFIG =================
+STARTED_AT = time.monotonic()
+FIRST_UPDATE_AT = None
+
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN missing in .env")
 
+# /stats komandasi uchun (Telegram user id lar, vergul bilan)
+ADMIN_IDS = {int(a) for a in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if a}
+
 IG_USERNAME = os.getenv("INSTAGRAM_USERNAME", "").strip()
 IG_PASSWORD = os.getenv("INSTAGRAM_PASSWORD", "").strip()
 
 SESSION_FILE = Path("insta_session")
 
+# Qo'shimcha akkauntlar: "user1:pass1,user2:pass2"
+IG_ACCOUNTS = [a.strip() for a in os.getenv("INSTAGRAM_ACCOUNTS", "").split(",") if a.strip()]
+SESSIONS_DIR = Path(os.getenv("SESSIONS_DIR", "sessions"))
+ACCOUNT_COOLDOWN = int(os.getenv("ACCOUNT_COOLDOWN", 60))  # 429 dan keyingi birinchi karantin, soniya
+ACCOUNT_MAX_COOLDOWN = int(os.getenv("ACCOUNT_MAX_COOLDOWN", 3600))  # karantin ikki barobar oshadi, max
+
+# Instagram so'rovlari tezligi (AIMD token bucket), har bir akkaunt uchun alohida, so'rov/soniya
+IG_RATE = float(os.getenv("IG_RATE", 1.0))  # boshlang'ich
+IG_RATE_MIN = float(os.getenv("IG_RATE_MIN", 0.05))
+IG_RATE_MAX = float(os.getenv("IG_RATE_MAX", 1.0))
+IG_RATE_BURST = int(os.getenv("IG_RATE_BURST", 3))
+IG_RATE_INCREASE = 0.02  # har muvaffaqiyatli so'rovda
+IG_RATE_DECREASE = 0.5  # 429 bo'lsa
+
+# Lokal telegram-bot-api server (masalan http://localhost:8081)
+# Fayllar yo'li (file://) bilan yuboriladi - server ularni o'zi o'qiydi,
+# shuning uchun WORK_DIR server bilan bir xil yo'lda ko'rinishi kerak (docker bo'lsa volume)
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip().rstrip("/")
+LOCAL_BOT_API = bool(BOT_API_URL)
+BOT_API_KWARGS = {
+    "base_url": f"{BOT_API_URL}/bot",
+    "base_file_url": f"{BOT_API_URL}/file/bot",
+    "local_mode": True,
+} if LOCAL_BOT_API else {}
+WORK_DIR = os.getenv("WORK_DIR") or None  # vaqtinchalik fayllar (default: tizim tmp)
+
 # Telegram limits
-MAX_VIDEO_SIZE = 50 * 1024 * 1024  # 50MB
+if LOCAL_BOT_API:
+    MAX_VIDEO_SIZE = 2000 * 1024 * 1024  # 2GB - compress deyarli kerak bo'lmaydi
+else:
+    MAX_VIDEO_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_PHOTO_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_TIMEOUT = 600 if LOCAL_BOT_API else 90  # lokal server javobni Telegram'ga yuklagach qaytaradi
 
 # Compress settings
-TARGET_VIDEO_SIZE = 45 * 1024 * 1024  # 45MB target (5MB xavfsizlik uchun)
+TARGET_VIDEO_SIZE = MAX_VIDEO_SIZE - 5 * 1024 * 1024  # 5MB xavfsizlik uchun
 DOWNLOAD_TIMEOUT = 120
 
+# Bitrate targeting
+RESOLUTION_LADDER = (720, 540, 480)  # qisqa tomon bo'yicha
+MIN_BITS_PER_PIXEL = 0.05  # bundan past bo'lsa keyingi resolution
+MIN_VIDEO_BITRATE = 150_000  # bps
+VBV_SECONDS = 2  # bufsize = maxrate * VBV_SECONDS
+MUX_OVERHEAD = 0.02  # MP4 konteyner uchun zaxira
+
+# Katta videolar: "compress", "split" yoki "compress_split" (compress bo'lmasa split)
+OVERSIZE_MODE = os.getenv("OVERSIZE_MODE", "compress").strip().lower()
+SPLIT_FILL = 0.85  # qism hajmi ~ MAX_VIDEO_SIZE * SPLIT_FILL
+MAX_SPLIT_PARTS = 10  # bitta media group
+
+# Kichik medialarni Telegram o'zi URL dan yuklaydi (server orqali emas)
+URL_UPLOAD = os.getenv("URL_UPLOAD", "1") == "1"
+URL_PHOTO_LIMIT = 5 * 1024 * 1024  # Bot API: URL orqali rasm 5MB gacha
+URL_VIDEO_LIMIT = 20 * 1024 * 1024  # Bot API: URL orqali boshqa fayllar 20MB gacha
+
+# Katta videoni yuklash bilan bir vaqtda encode qilish (disk orqali emas)
+STREAM_TRANSCODE = os.getenv("STREAM_TRANSCODE", "1") == "1"
+
+# File_id kesh (qayta yuborish uchun)
+CACHE_DB = Path(os.getenv("CACHE_DB", "cache.db"))
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", 30 * 24 * 3600))  # 30 kun
+FILE_ID_CACHE_MAX = int(os.getenv("FILE_ID_CACHE_MAX", 50000))
+
+# Yuklangan / compress qilingan fayllar keshi (diskda)
+MEDIA_CACHE_DIR = Path(os.getenv("MEDIA_CACHE_DIR", "media_cache"))
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_BYTES", 2 * 1024 * 1024 * 1024))  # 2GB, 0 = o'chirilgan
+
+# CDN HTTP client (connection pool)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 32))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", 8))
+HTTP_KEEPALIVE = int(os.getenv("HTTP_KEEPALIVE", 60))  # soniya
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))  # soniya
+HTTP_CONNECT_TIMEOUT = int(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = int(os.getenv("HTTP_READ_TIMEOUT", 30))  # chunklar orasidagi max kutish
+
+# Katta fayllarni bir nechta Range so'rov bilan parallel yuklash
+RANGE_MIN_SIZE = int(os.getenv("RANGE_MIN_SIZE", 8 * 1024 * 1024))  # bundan kichik - bitta oqim
+RANGE_PARTS = int(os.getenv("RANGE_PARTS", 4))
+RANGE_RETRIES = 5  # har bir qism uchun, yangi baytlar kelsa qaytadan sanaladi
+RANGE_BACKOFF = 0.5  # soniya, har urinishda ikki barobar + jitter
+
+# Navbat va parallel ishlash limitlari
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", 8))  # pipeline ichidagi joblar
+QUEUE_MAX = int(os.getenv("QUEUE_MAX", 50))
+PER_USER_ACTIVE = int(os.getenv("PER_USER_ACTIVE", 1))
+PER_USER_QUEUED = int(os.getenv("PER_USER_QUEUED", 5))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", 16))
+# Har bir bosqich uchun workerlar soni
+STAGE_LIMITS = {
+    "fetch": int(os.getenv("FETCH_CONCURRENCY", 2 * (1 + len(IG_ACCOUNTS)))),  # Instagram metadata (akkauntlar soniga qarab)
+    "download": int(os.getenv("DOWNLOAD_CONCURRENCY", 4)),  # CDN
+    "transcode": int(os.getenv("TRANSCODE_CONCURRENCY", 1)),  # ffmpeg
+    "upload": int(os.getenv("UPLOAD_CONCURRENCY", 3)),  # Telegram
+}
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 600))  # bitta job uchun max soniya
+SESSION_CHECK_INTERVAL = int(os.getenv("SESSION_CHECK_INTERVAL", 1800))  # session tekshirish, soniya
+SESSION_RELOAD_INTERVAL = int(os.getenv("SESSION_RELOAD_INTERVAL", 60))  # worker: session fayllarini qayta o'qish
+
+# Worker rejimi: main() faqat update qabul qiladi, yuklashni WORKERS ta protsess bajaradi
+# (0 = hammasi bitta protsessda). Limitlar (MAX_ACTIVE_JOBS, IG_RATE...) har bir worker uchun alohida
+WORKERS = int(os.getenv("WORKERS", 0))
+JOB_LEASE = int(os.getenv("JOB_LEASE", 120))  # soniya, worker yiqilsa shundan keyin boshqasi oladi
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_POLL = 0.5  # bo'sh navbatni tekshirish oralig'i, soniya
+INSTA_THREADS = int(os.getenv("INSTA_THREADS", 2 * STAGE_LIMITS["fetch"]))  # Instaloader uchun thread pool
+
+# Post ma'lumotlari uchun backendlar (birinchisi asosiy) va hedging
+EXTRACTORS = [e.strip() for e in os.getenv("EXTRACTORS", "instaloader,yt-dlp").split(",") if e.strip()]
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", 3.0))  # asosiy shuncha soniyada javob bermasa ikkinchisi ham
+YTDLP_COOKIES = Path(os.getenv("YTDLP_COOKIES", "cookies.txt"))
+
+# Post metadata kesh
+POST_CACHE_TTL = int(os.getenv("POST_CACHE_TTL", 6 * 3600))  # CDN imzosidan ham cheklanadi
+POST_NEGATIVE_TTL = int(os.getenv("POST_NEGATIVE_TTL", 600))  # topilmagan / yopiq
+POST_CACHE_MEMORY = int(os.getenv("POST_CACHE_MEMORY", 2000))
+POST_CACHE_MAX = int(os.getenv("POST_CACHE_MAX", 50000))
+
+# Story kesh
+STORY_CACHE_TTL = int(os.getenv("STORY_CACHE_TTL", 300))  # soniya
+STORY_CACHE_USERS = int(os.getenv("STORY_CACHE_USERS", 10000))  # username -> userid
+
+# Event loop kechikishini kuzatish
+LOOP_LAG_INTERVAL = 0.5  # soniya
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", 0.2))  # soniya
+
+# Prometheus /metrics (0 = o'chirilgan). Worker rejimida worker i porti METRICS_PORT + 1 + i
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# ffmpeg CPU limiti (default: yadrolar transcode workerlari orasida bo'linadi)
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", 0)) or max(1, (os.cpu_count() or 1) // STAGE_LIMITS["transcode"])
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", 10))  # 0 = o'zgartirmaslik
+
 # ================= INSTALOADER =================
-L = instaloader.Instaloader(
-    download_video_thumbnails=False,
-    download_geotags=False,
-    download_comments=False,
-    save_metadata=False,
-    compress_json=False,
-    post_metadata_txt_pattern="",
-    quiet=True,
-    sleep=False,
-)
+def new_loader():
+    return instaloader.Instaloader(
+        download_video_thumbnails=False,
+        download_geotags=False,
+        download_comments=False,
+        save_metadata=False,
+        compress_json=False,
+        post_metadata_txt_pattern="",
+        quiet=True,
+        sleep=False,
+    )
+
+
+L = new_loader()
 
 
-def setup_session():
+def setup_session(
+    loader=L,
+    username=IG_USERNAME,
+    password=IG_PASSWORD,
+    session_file=SESSION_FILE,
+    cookies=True,
+):
     """Instagram sessionni sozlash"""
-    if IG_USERNAME and SESSION_FILE.exists():
+    if username and session_file.exists():
         try:
-            L.load_session_from_file(IG_USERNAME, str(SESSION_FILE))
-            if L.test_login() == IG_USERNAME:
+            loader.load_session_from_file(username, str(session_file))
+            if loader.test_login() == username:
                 return True
         except Exception:
-            SESSION_FILE.unlink(missing_ok=True)
+            session_file.unlink(missing_ok=True)
 
-    if IG_USERNAME and IG_PASSWORD:
+    if username and password:
         try:
-            L.login(IG_USERNAME, IG_PASSWORD)
-            L.save_session_to_file(str(SESSION_FILE))
+            loader.login(username, password)
+            loader.save_session_to_file(str(session_file))
             return True
         except Exception as e:
-            print(f"Login error: {e}")
+            print(f"Login error ({username}): {e}")
 
-    if browser_cookie3:
+    if cookies and browser_cookie3:
         for fn in (browser_cookie3.chrome, browser_cookie3.firefox, browser_cookie3.edge):
             try:
                 cj = fn(domain_name="instagram.com")
-                L.context._session.cookies.update(cj)
-                if L.test_login():
-                    L.save_session_to_file(str(SESSION_FILE))
+                loader.context._session.cookies.update(cj)
+                if loader.test_login():
+                    loader.save_session_to_file(str(session_file))
                     return True
             except Exception:
                 continue
@@ -86,351 +253,2904 @@ def setup_session():
     return False
 
 
-setup_session()
+def is_rate_limited(error: Exception) -> bool:
+    """Instagram cheklovi (429) - login talab qilinishi bu emas"""
+    if isinstance(error, instaloader.exceptions.TooManyRequestsException):
+        return True
+    error_msg = str(error)
+    return "429" in error_msg or "rate limit" in error_msg.lower()
 
 
-# ================= VIDEO COMPRESSION =================
-def check_ffmpeg():
-    """FFmpeg o'rnatilganligini tekshirish"""
-    try:
-        subprocess.run(['ffmpeg', '-version'], 
-                      stdout=subprocess.PIPE, 
-                      stderr=subprocess.PIPE, 
-                      check=True)
-        return True
-    except:
-        return False
+class AdaptiveRateLimiter:
+    """
+    Bitta akkaunt so'rovlari uchun token bucket (AIMD)
+    - Har bir so'rov token oladi, token bo'lmasa event loopda kutadi (xato bermaydi, thread band emas)
+    - 429 bo'lsa tezlik keskin kamayadi (x decrease) va akkaunt pauzaga (karantin):
+      har safar 2 barobar uzoqroq, max_pause dan oshmaydi
+    - Bitta pauza davomida kelgan parallel 429 lar bitta strike hisoblanadi
+    - Muvaffaqiyatli so'rovlarda sekin tiklanadi (+increase)
+    - Faqat event loopdan chaqiriladi
+    """
 
+    def __init__(self, rate: float, min_rate: float, max_rate: float, burst: int,
+                 increase: float, decrease: float, backoff: float, max_pause: float):
+        self.rate = rate  # so'rov/soniya
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_pause = max_pause
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.strikes = 0
+        self.throttles = 0
 
-async def compress_video(input_path: Path, output_path: Path, target_size: int):
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Keyingi token uchun kutish, soniya (0 - hozir olish mumkin)"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def on_success(self):
+        self.strikes = 0
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self) -> float:
+        """429: pauza (soniya), yoki 0 - shu pauza uchun allaqachon hisoblangan"""
+        now = time.monotonic()
+        self.throttles += 1
+        if now < self.paused_until:
+            return 0.0
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0.0
+        pause = min(self.backoff * 2 ** self.strikes, self.max_pause)
+        self.strikes += 1
+        self.paused_until = now + pause
+        return pause
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 3),
+            "tokens": round(self.tokens, 2),
+            "throttles": self.throttles,
+            "quarantine_left": max(0, round(self.paused_until - time.monotonic())),
+        }
+
+
+def new_limiter() -> AdaptiveRateLimiter:
+    return AdaptiveRateLimiter(
+        IG_RATE, IG_RATE_MIN, IG_RATE_MAX, IG_RATE_BURST,
+        IG_RATE_INCREASE, IG_RATE_DECREASE, ACCOUNT_COOLDOWN, ACCOUNT_MAX_COOLDOWN,
+    )
+
+
+class Account:
+    """Pooldagi bitta Instagram akkaunt (yoki anonim session)"""
+
+    def __init__(self, name: str, loader, username: str = "", password: str = "",
+                 session_file: Path = SESSION_FILE, cookies: bool = False):
+        self.name = name
+        self.loader = loader
+        self.username = username
+        self.password = password
+        self.session_file = session_file
+        self.cookies = cookies  # brauzer cookie'larini sinash (faqat asosiy akkaunt)
+        self.ready = False  # session tekshirilgan va ishlatish mumkin
+        self.logged_in = False  # login qilingan session (storylar uchun kerak)
+        self.checked_at = 0.0
+        self.limiter = new_limiter()
+        self.in_flight = 0
+        self.requests = deque()  # oxirgi so'rovlar vaqti (rate uchun)
+        self.total = 0
+        self.errors = 0
+
+
+class AccountPool:
     """
-    Videoni compress qilish (low-end laptop uchun optimallashtirilgan)
-    
-    Strategy:
-    - 720p maksimum resolution
-    - CRF (Constant Rate Factor) usuli - tezroq va sifatliroq
-    - Hardware acceleration (agar mavjud bo'lsa)
+    Bir nechta Instagram akkaunt orasida so'rovlarni taqsimlash
+    - Har bir akkauntning o'z rate limiteri bor: akkauntlar soni oshsa o'tkazuvchanlik ham oshadi,
+      bitta akkauntdagi 429 boshqalarini sekinlashtirmaydi
+    - Tokeni bor, eng kam band bo'lgan sog'lom akkaunt tanlanadi
+    - 429 bo'lsa faqat shu akkaunt karantinga (limiter pauzasi)
+    - Login talab qilinsa: anonim asosiy akkaunt ishlashda davom etadi; loginli akkaunt
+      rotatsiyadan chiqadi va darhol fonda qayta login qilinadi (worker rejimida front protsess)
+    - Token / karantin kutish event loopda (JOB_TIMEOUT gacha), thread faqat so'rovning o'zi uchun
     """
-    try:
-        # Video ma'lumotlarini olish
-        probe_cmd = [
-            'ffprobe', '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=duration,bit_rate',
-            '-of', 'default=noprint_wrappers=1',
-            str(input_path)
-        ]
-        
-        probe_result = await asyncio.create_subprocess_exec(
-            *probe_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, _ = await probe_result.communicate()
-        
-        # CRF usuli bilan compress (low-end uchun optimal)
-        # CRF 28 = yaxshi sifat va yengil fayl
-        compress_cmd = [
-            'ffmpeg', '-i', str(input_path),
-            '-c:v', 'libx264',  # H.264 codec
-            '-crf', '28',  # Quality (18=yuqori, 28=yaxshi, 32=past)
-            '-preset', 'veryfast',  # Low-end laptop uchun
-            '-vf', 'scale=-2:720',  # 720p max
-            '-c:a', 'aac',  # Audio codec
-            '-b:a', '128k',  # Audio bitrate
-            '-movflags', '+faststart',  # Web uchun optimizatsiya
-            '-y',  # Overwrite
-            str(output_path)
-        ]
+
+    def __init__(self, accounts: list, max_wait: float):
+        self.accounts = accounts
+        self.max_wait = max_wait  # token / karantin tugashini kutish chegarasi
+        self.waiting = 0
+        self.can_login = True  # worker protsesslarda False - sessionlarni front yangilaydi
+        self.refreshing = {}  # account -> qayta login task
+
+    async def _acquire(self, login: bool) -> Account:
+        """Tokeni bor akkaunt; bo'lmasa eng birinchi bo'shaydiganini kutish"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            candidates = [a for a in self.accounts if a.ready and (a.logged_in or not login)]
+            if not candidates:
+                raise instaloader.exceptions.LoginRequiredException("no logged-in Instagram account")
+            delays = [(a.limiter.delay(now), a) for a in candidates]
+            free = [a for delay, a in delays if delay <= 0]
+            if free:
+                account = min(free, key=lambda a: (a.in_flight, len(a.requests)))
+                account.limiter.take()
+                account.in_flight += 1
+                account.total += 1
+                account.requests.append(now)
+                while account.requests and account.requests[0] < now - 60:
+                    account.requests.popleft()
+                return account
+            
+            wait = min(delay for delay, _ in delays)
+            if now + wait > deadline:
+                raise instaloader.exceptions.TooManyRequestsException(
+                    f"429: all Instagram accounts are rate limited ({wait:.0f}s left)"
+                )
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+
+    async def run(self, fn, *args, login: bool = False):
+        """
+        fn(loader, *args) ni tanlangan akkaunt bilan Instaloader threadida bajarish
         
-        process = await asyncio.create_subprocess_exec(
-            *compress_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        login=True - faqat login qilingan akkauntlar (storylar)
+        """
+        account = await self._acquire(login)
+        loop = asyncio.get_running_loop()
+        future = INSTA_POOL.submit(fn, account.loader, *args)
+        # Job bekor qilinsa ham thread oxirigacha ishlaydi - natija baribir hisobga olinadi
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, account, f))
+        return await asyncio.wrap_future(future)
+
+    def _release(self, account: Account, future):
+        account.in_flight -= 1
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            account.limiter.on_success()
+            return
         
-        await process.communicate()
+        account.errors += 1
+        if isinstance(error, instaloader.exceptions.LoginRequiredException):
+            # Cheklov emas: anonim akkaunt yoki session eskirgan
+            account.logged_in = False
+            if account.username:
+                if account is not self.accounts[0]:
+                    account.ready = False
+                self._refresh(account)
+        elif is_rate_limited(error):
+            pause = account.limiter.on_throttle()
+            if pause:
+                print(f"Account {account.name} quarantined for {pause:.0f}s "
+                      f"({account.limiter.rate:.2f} req/s): {error}")
+
+    def _refresh(self, account: Account):
+        """Eskirgan sessionni darhol fonda qayta tekshirish / login"""
+        if not self.can_login or account in self.refreshing:
+            return
         
-        # Compress bo'lgan fayl hajmini tekshirish
-        if output_path.exists():
-            new_size = output_path.stat().st_size
-            if new_size <= target_size:
-                return True
-            else:
-                # Agar hali katta bo'lsa, CRF ni oshirish
-                compress_cmd[6] = '32'  # CRF 32
-                
-                process = await asyncio.create_subprocess_exec(
-                    *compress_cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                
-                await process.communicate()
-                return output_path.exists()
+        async def refresh():
+            try:
+                ok = await run_insta(refresh_session, account)
+                print(f"🔑 Instagram {account.name}: {'✅ session yangilandi' if ok else '⚠️ login yo‘q'}")
+            except Exception as e:
+                print(f"Session refresh error ({account.name}): {e}")
+            finally:
+                self.refreshing.pop(account, None)
         
+        self.refreshing[account] = asyncio.create_task(refresh())
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "waiting": self.waiting,
+            **{
+                a.name: {
+                    "requests_per_min": sum(1 for t in a.requests if t >= now - 60),
+                    "total": a.total,
+                    "errors": a.errors,
+                    "in_flight": a.in_flight,
+                    "ready": a.ready,
+                    "logged_in": a.logged_in,
+                    **a.limiter.stats(),
+                }
+                for a in self.accounts
+            },
+        }
+
+
+def load_saved_session(account: Account) -> bool:
+    """Saqlangan session faylini o'qish (tarmoq so'rovi yo'q)"""
+    if not (account.username and account.session_file.exists()):
         return False
-        
-    except Exception as e:
-        print(f"Compress error: {e}")
+    try:
+        account.loader.load_session_from_file(account.username, str(account.session_file))
+        account.logged_in = True
+        return True
+    except Exception:
         return False
 
 
-# ================= ASYNC DOWNLOAD =================
-async def download_file_async(url: str, path: Path, session: aiohttp.ClientSession):
-    """Async ravishda fayl yuklash"""
+def build_accounts():
+    """
+    Akkauntlar: .env dagi asosiy akkaunt (yoki anonim) + INSTAGRAM_ACCOUNTS
+    
+    INSTAGRAM_ACCOUNTS="user1:pass1,user2:pass2" - sessionlar SESSIONS_DIR/<user> da saqlanadi
+    Bu yerda tarmoq so'rovi yo'q: faqat saqlangan sessionlar o'qiladi,
+    tekshirish va login fonda (session_health_loop) bajariladi
+    """
+    primary = Account(IG_USERNAME or "anonymous", L, IG_USERNAME, IG_PASSWORD, SESSION_FILE, cookies=True)
+    load_saved_session(primary)
+    primary.ready = True  # anonim bo'lsa ham ochiq postlar uchun ishlaydi
+    accounts = [primary]
+    
+    for spec in IG_ACCOUNTS:
+        username, _, password = spec.partition(":")
+        account = Account(username, new_loader(), username, password, SESSIONS_DIR / username)
+        account.ready = load_saved_session(account)
+        accounts.append(account)
+    
+    return accounts
+
+
+ACCOUNTS = AccountPool(build_accounts(), JOB_TIMEOUT)
+
+
+def refresh_session(account: Account) -> bool:
+    """Sessionni tekshirish, yaroqsiz bo'lsa qayta login (thread ichida)"""
+    loader = account.loader
+    ok = False
     try:
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)) as response:
-            if response.status == 200:
-                with open(path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(65536):
-                        f.write(chunk)
-                return True
-    except Exception as e:
-        print(f"Download error for {url}: {e}")
-    return False
+        ok = bool(account.username) and loader.test_login() == account.username
+    except Exception:
+        pass
+    
+    if not ok and (account.username or (account.cookies and not account.checked_at)):
+        account.session_file.parent.mkdir(exist_ok=True)
+        ok = setup_session(
+            loader,
+            account.username,
+            account.password,
+            account.session_file,
+            cookies=account.cookies and not account.checked_at,
+        )
+    
+    account.checked_at = time.time()
+    account.logged_in = ok
+    # Asosiy akkaunt login bo'lmasa ham anonim ishlaydi
+    account.ready = ok or account is ACCOUNTS.accounts[0]
+    return ok
 
 
-async def download_post_media(post, tmp: Path):
-    """Post medialarini async yuklab olish"""
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        
-        if post.mediacount > 1:
-            # Carousel
-            for i, node in enumerate(post.get_sidecar_nodes(), 1):
-                if node.is_video:
-                    url = node.video_url
-                    filename = f"{i:02d}.mp4"
-                else:
-                    url = node.display_url
-                    filename = f"{i:02d}.jpg"
-                
-                tasks.append(download_file_async(url, tmp / filename, session))
-        else:
-            # Single post/reel
-            if post.is_video:
-                url = post.video_url
-                filename = "video.mp4"
-            else:
-                url = post.url
-                filename = "photo.jpg"
-            
-            tasks.append(download_file_async(url, tmp / filename, session))
-        
-        await asyncio.gather(*tasks)
+# ================= INSTAGRAM FACADE =================
+@dataclass(frozen=True)
+class MediaItem:
+    """Bitta media fayl (CDN URL)"""
+    url: str
+    type: str  # "photo" yoki "video"
+    filename: str
+    duration: float | None = None
 
 
-async def download_story_media(story, tmp: Path):
-    """Story mediasini yuklab olish"""
-    async with aiohttp.ClientSession() as session:
-        if story.is_video:
-            url = story.video_url
-            filename = "story.mp4"
-        else:
-            url = story.url
-            filename = "story.jpg"
-        
-        await download_file_async(url, tmp / filename, session)
+@dataclass(frozen=True)
+class MediaDescriptor:
+    """
+    To'liq yuklangan post yoki story
+    
+    Instaloader obyektlari lazy - property o'qilganda HTTP so'rov ketishi mumkin.
+    Shuning uchun hammasi thread poolda o'qiladi, bot qolgan qismi faqat shu bilan ishlaydi.
+    """
+    key: str  # "post:<shortcode>" yoki "story:<mediaid>"
+    caption: str
+    items: tuple[MediaItem, ...]
 
 
-# ================= PROCESS MEDIA =================
-async def process_media(tmp: Path, status_callback=None):
-    """Yuklab olingan medialarni qayta ishlash va compress qilish"""
-    media = []
-    has_ffmpeg = check_ffmpeg()
+INSTA_POOL = ThreadPoolExecutor(max_workers=INSTA_THREADS, thread_name_prefix="instaloader")
+
+
+async def run_insta(fn, *args):
+    """Instaloader chaqiruvini alohida (cheklangan) thread poolda bajarish"""
+    return await asyncio.get_running_loop().run_in_executor(INSTA_POOL, partial(fn, *args))
+
+
+def describe_post(post, shortcode: str) -> MediaDescriptor:
+    """Post -> MediaDescriptor (thread ichida)"""
+    items = []
     
-    for f in sorted(tmp.iterdir()):
-        if not f.is_file():
-            continue
-        
-        size = f.stat().st_size
-        ext = f.suffix.lower()
-        
-        if ext in (".mp4", ".mov"):
-            # Video fayl
-            if size > MAX_VIDEO_SIZE:
-                if has_ffmpeg:
-                    # Compress qilish
-                    if status_callback:
-                        await status_callback("🔄 Video compress qilinmoqda...")
-                    
-                    compressed_path = tmp / f"compressed_{f.name}"
-                    success = await compress_video(f, compressed_path, TARGET_VIDEO_SIZE)
-                    
-                    if success and compressed_path.exists():
-                        compressed_size = compressed_path.stat().st_size
-                        if compressed_size <= MAX_VIDEO_SIZE:
-                            media.append({
-                                "path": str(compressed_path),
-                                "type": "video",
-                                "size": compressed_size,
-                                "compressed": True
-                            })
-                            continue
-                
-                # Compress muvaffaqiyatsiz yoki FFmpeg yo'q
-                media.append({
-                    "path": str(f),
-                    "type": "too_large",
-                    "size": size
-                })
+    if post.mediacount > 1:
+        # Carousel
+        for i, node in enumerate(post.get_sidecar_nodes(), 1):
+            if node.is_video:
+                items.append(MediaItem(node.video_url, "video", f"{i:02d}.mp4"))
             else:
-                # Kichik video - compress kerak emas
-                media.append({
-                    "path": str(f),
-                    "type": "video",
-                    "size": size,
-                    "compressed": False
-                })
-        
-        elif ext in (".jpg", ".jpeg", ".png", ".webp"):
-            # Rasm fayl
-            if size <= MAX_PHOTO_SIZE:
-                media.append({
-                    "path": str(f),
-                    "type": "photo",
-                    "size": size
-                })
+                items.append(MediaItem(node.display_url, "photo", f"{i:02d}.jpg"))
+    else:
+        # Single post/reel
+        if post.is_video:
+            items.append(MediaItem(post.video_url, "video", "video.mp4", post.video_duration))
+        else:
+            items.append(MediaItem(post.url, "photo", "photo.jpg"))
     
-    return media
+    return MediaDescriptor(f"post:{shortcode}", post.caption or "", tuple(items))
 
 
-def clean_caption(text: str, max_length: int = 200) -> str:
+def describe_story_item(story) -> MediaDescriptor:
+    """StoryItem -> MediaDescriptor (thread ichida)"""
+    if story.is_video:
+        item = MediaItem(story.video_url, "video", "story.mp4")
+    else:
+        item = MediaItem(story.url, "photo", "story.jpg")
+    return MediaDescriptor(f"story:{story.mediaid}", "", (item,))
+
+
+def load_post(loader, shortcode: str) -> MediaDescriptor:
+    """Post -> MediaDescriptor (thread ichida, ACCOUNTS.run orqali)"""
+    post = instaloader.Post.from_shortcode(loader.context, shortcode)
+    return describe_post(post, shortcode)
+
+
+class StoryCache:
     """
-    Captionni tozalash va qisqartirish
-    - Hashtag va mentionlarni olib tashlash
-    - Emoji saqlab qolish
-    - Ko'p bo'sh joylarni tozalash
+    Story linklari uchun kesh (event loopda ishlaydi)
+    - username -> userid: uzoq muddatli LRU (userid o'zgarmaydi)
+    - userid -> storylar: mediaid bo'yicha indeks, qisqa TTL va story muddati bilan cheklangan
+    - Bitta foydalanuvchi uchun TTL ichida ko'pi bilan bitta Instagram so'rovi
+    - Foydalanuvchi locklari belgilangan to'plamdan (userid hash bo'yicha) - cheksiz o'smaydi
     """
-    if not text:
-        return "📥 Instagram"
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, ttl: int, max_users: int):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.userids = OrderedDict()  # username -> userid
+        self.reels = {}  # userid -> {"fetched", "expires", "items": {mediaid: (expires, desc)}, "order": [mediaid]}
+        self.lock = threading.Lock()
+        self.user_locks = [asyncio.Lock() for _ in range(self.LOCK_STRIPES)]
+        self.hits = 0
+        self.misses = 0
+
+    def userid(self, username: str):
+        with self.lock:
+            userid = self.userids.get(username)
+            if userid is not None:
+                self.userids.move_to_end(username)
+            return userid
+
+    def set_userid(self, username: str, userid: int):
+        with self.lock:
+            self.userids[username] = userid
+            self.userids.move_to_end(username)
+            while len(self.userids) > self.max_users:
+                self.userids.popitem(last=False)
+
+    def user_lock(self, userid: int) -> asyncio.Lock:
+        return self.user_locks[hash(userid) % len(self.user_locks)]
+
+    def reel(self, userid: int):
+        """Amal qilayotgan storylar indeksi yoki None"""
+        now = time.time()
+        with self.lock:
+            reel = self.reels.get(userid)
+            if reel is None or reel["expires"] <= now:
+                self.reels.pop(userid, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return reel
+
+    def set_reel(self, userid: int, items: list):
+        """items: [(mediaid, expires, desc)] - Instagram tartibida"""
+        now = time.time()
+        expires = min([now + self.ttl] + [e for _, e, _ in items])
+        with self.lock:
+            # Muddati o'tgan boshqa foydalanuvchilarni tozalash
+            for uid in [u for u, r in self.reels.items() if r["expires"] <= now]:
+                del self.reels[uid]
+            reel = {
+                "fetched": now,
+                "expires": expires,
+                "items": {mediaid: (e, desc) for mediaid, e, desc in items},
+                "order": [mediaid for mediaid, _, _ in items],
+            }
+            self.reels[userid] = reel
+            return reel
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "users": len(self.userids),
+            "reels": len(self.reels),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+STORY_CACHE = StoryCache(STORY_CACHE_TTL, STORY_CACHE_USERS)
+
+
+def load_story_reel(loader, userid: int):
+    """Foydalanuvchining barcha storylari -> [(mediaid, expires, desc)] (thread ichida)"""
+    items = []
+    for user_story in loader.get_stories([userid]):
+        for item in user_story.get_items():
+            expires = item.expiring_utc.replace(tzinfo=timezone.utc).timestamp()
+            items.append((str(item.mediaid), expires, describe_story_item(item)))
+    return items
+
+
+def load_userid(loader, username: str) -> int:
+    return instaloader.Profile.from_username(loader.context, username).userid
+
+
+async def load_story(username: str, story_id):
+    """Story topish -> MediaDescriptor yoki None"""
+    started = time.time()
     
-    # Hashtag va mentionlarni olib tashlash
-    text = re.sub(r'#\w+', '', text)
-    text = re.sub(r'@\w+', '', text)
+    # Profile olish (userid keshlanadi)
+    userid = STORY_CACHE.userid(username)
+    if userid is None:
+        userid = await ACCOUNTS.run(load_userid, username)
+        STORY_CACHE.set_userid(username, userid)
     
-    # Ko'p bo'sh joylarni tozalash
-    text = re.sub(r'\s+', ' ', text)
-    text = re.sub(r'\n\s*\n', '\n', text)
-    text = text.strip()
+    # Storylar (bitta foydalanuvchi uchun bir vaqtda bitta so'rov)
+    async with STORY_CACHE.user_lock(userid):
+        reel = STORY_CACHE.reel(userid)
+        # Keshdagi reelda so'ralgan story yo'q - yangi qo'yilgan bo'lishi mumkin, bir marta qayta olinadi
+        # (shu so'rov boshlangandan keyin olingan reel yetarlicha yangi)
+        stale = reel is not None and story_id and story_id not in reel["items"] and reel["fetched"] < started
+        if reel is None or stale:
+            reel = STORY_CACHE.set_reel(userid, await ACCOUNTS.run(load_story_reel, userid, login=True))
     
-    # Bo'sh bo'lsa default caption
-    if not text or len(text) < 3:
-        return "📥 Instagram"
+    # Story ID bo'yicha qidirish
+    now = time.time()
+    if story_id and story_id in reel["items"]:
+        expires, desc = reel["items"][story_id]
+        if expires > now:
+            return desc
     
-    # Uzunlikni cheklash
-    if len(text) > max_length:
-        text = text[:max_length].rsplit(' ', 1)[0] + "..."
+    # Agar ID yangi olingan reelda ham topilmasa, eng yangi storyni olish
+    for mediaid in reel["order"]:
+        expires, desc = reel["items"][mediaid]
+        if expires > now:
+            return desc
     
-    return f"📥 {text}"
+    return None
 
 
-# ================= SEND MEDIA =================
-async def send_media(update: Update, media: list, caption: str):
-    """Medialarni Telegramga yuborish"""
-    if not media:
-        await update.message.reply_text("❌ Media topilmadi")
-        return
-    
-    # Juda katta fayllar borligini tekshirish
-    too_large = [m for m in media if m["type"] == "too_large"]
-    if too_large:
-        total_size = sum(m["size"] for m in too_large) / (1024 * 1024)
+def cdn_expiry(url: str):
+    """Instagram CDN URL imzosining tugash vaqti (oe= hex timestamp) yoki None"""
+    oe = parse_qs(urlparse(url).query).get("oe")
+    try:
+        return int(oe[0], 16) if oe else None
+    except ValueError:
+        return None
+
+
+class PostCache:
+    """
+    Post ma'lumotlari keshi: xotirada LRU + diskda SQLite
+    - Yozuv CDN URL imzosi tugashidan oldin eskiradi
+    - Topilmagan / yopiq postlar ham qisqa muddat saqlanadi (negative cache)
+    - Diskka yozish thread ichida, hajm bo'yicha tozalash har TRIM_EVERY yozuvda
+    """
+
+    TRIM_EVERY = 100
+
+    ERRORS = {
+        "not_found": instaloader.exceptions.QueryReturnedNotFoundException,
+        "private": instaloader.exceptions.PrivateProfileNotFollowedException,
+    }
+
+    def __init__(self, path: Path, ttl: int, negative_ttl: int, memory_max: int, max_entries: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory_max = memory_max
+        self.max_entries = max_entries
+        self.memory = OrderedDict()  # shortcode -> (expires, desc yoki xato turi)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            " shortcode TEXT PRIMARY KEY,"
+            " data TEXT,"
+            " error TEXT,"
+            " expires REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS posts_expires ON posts (expires)")
+        self.db.commit()
+
+    def _remember(self, shortcode: str, expires: float, value):
+        self.memory[shortcode] = (expires, value)
+        self.memory.move_to_end(shortcode)
+        while len(self.memory) > self.memory_max:
+            self.memory.popitem(last=False)
+
+    def get(self, shortcode: str):
+        """MediaDescriptor, yoki None (keshda yo'q). Negative yozuv bo'lsa o'sha xato chiqadi"""
+        now = time.time()
+        entry = self.memory.get(shortcode)
         
-        if not check_ffmpeg():
-            await update.message.reply_text(
-                f"⚠️ Video juda katta ({total_size:.1f} MB)\n\n"
-                f"❗️ FFmpeg o'rnatilmagan, compress qilib bo'lmadi.\n\n"
-                f"Server adminiga xabar bering:\n"
-                f"`sudo apt install ffmpeg -y`"
+        if entry is None:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT data, error, expires FROM posts WHERE shortcode = ? AND expires > ?",
+                    (shortcode, now)
+                ).fetchone()
+            if row:
+                data, error, expires = row
+                value = error if error else self._decode(data)
+                self._remember(shortcode, expires, value)
+                entry = (expires, value)
+        
+        if entry is None or entry[0] <= now:
+            self.memory.pop(shortcode, None)
+            self.misses += 1
+            return None
+        
+        self.memory.move_to_end(shortcode)
+        value = entry[1]
+        if isinstance(value, str):
+            self.negative_hits += 1
+            raise self.ERRORS[value](f"{shortcode}: cached {value}")
+        
+        self.hits += 1
+        return value
+
+    async def put(self, shortcode: str, desc: MediaDescriptor):
+        now = time.time()
+        expires = now + self.ttl
+        # CDN imzosi tugashidan 10 daqiqa oldin eskiradi
+        signed = [e for e in (cdn_expiry(item.url) for item in desc.items) if e]
+        if signed:
+            expires = min(expires, min(signed) - 600)
+        if expires <= now:
+            return
+        
+        self._remember(shortcode, expires, desc)
+        await self._store(shortcode, json.dumps(asdict(desc)), None, expires)
+
+    async def put_error(self, shortcode: str, error: Exception):
+        for kind, cls in self.ERRORS.items():
+            if isinstance(error, cls):
+                expires = time.time() + self.negative_ttl
+                self._remember(shortcode, expires, kind)
+                await self._store(shortcode, None, kind, expires)
+                return
+
+    async def _store(self, shortcode: str, data, error, expires: float):
+        self.puts += 1
+        await asyncio.to_thread(self._write, shortcode, data, error, expires, self.puts % self.TRIM_EVERY == 0)
+
+    def _write(self, shortcode: str, data, error, expires: float, trim: bool):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO posts (shortcode, data, error, expires) VALUES (?, ?, ?, ?)",
+                (shortcode, data, error, expires)
             )
+            if trim:
+                # Eskirganlarni va limitdan oshganlarni o'chirish (expires indeksi bo'yicha)
+                self.db.execute("DELETE FROM posts WHERE expires <= ?", (time.time(),))
+                row = self.db.execute(
+                    "SELECT expires FROM posts ORDER BY expires DESC LIMIT 1 OFFSET ?",
+                    (self.max_entries,)
+                ).fetchone()
+                if row:
+                    self.db.execute("DELETE FROM posts WHERE expires <= ?", row)
+            self.db.commit()
+
+    @staticmethod
+    def _decode(data: str) -> MediaDescriptor:
+        raw = json.loads(data)
+        items = tuple(MediaItem(**item) for item in raw["items"])
+        return MediaDescriptor(raw["key"], raw["caption"], items)
+
+    def stats(self):
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            "memory": len(self.memory),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / total if total else 0.0,
+        }
+
+
+POST_CACHE = PostCache(CACHE_DB, POST_CACHE_TTL, POST_NEGATIVE_TTL, POST_CACHE_MEMORY, POST_CACHE_MAX)
+
+
+# ================= EXTRACTORS =================
+class Extractor:
+    """Post ma'lumotlari backendi: await load_post(shortcode) -> MediaDescriptor"""
+
+    name = ""
+
+    async def load_post(self, shortcode: str) -> MediaDescriptor:
+        raise NotImplementedError
+
+
+class InstaloaderExtractor(Extractor):
+    name = "instaloader"
+
+    async def load_post(self, shortcode: str) -> MediaDescriptor:
+        return await ACCOUNTS.run(load_post, shortcode)
+
+
+class YtDlpExtractor(Extractor):
+    """
+    yt-dlp orqali (Instaloader dan mustaqil so'rov yo'li)
+    
+    Fayl nomlari describe_post bilan bir xil - kesh kalitlari mos keladi.
+    O'z thread pooli bor: Instaloader threadlari band bo'lsa ham hedge ishga tushadi
+    """
+
+    name = "yt-dlp"
+
+    def __init__(self, cookiefile: Path):
+        self.options = {
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+            "ignore_no_formats_error": True,  # carouseldagi rasmlar
+            "format": "best[ext=mp4]/best",
+            "socket_timeout": HTTP_READ_TIMEOUT,
+        }
+        if cookiefile.exists():
+            self.options["cookiefile"] = str(cookiefile)
+        self.pool = ThreadPoolExecutor(max_workers=STAGE_LIMITS["fetch"], thread_name_prefix="yt-dlp")
+
+    async def load_post(self, shortcode: str) -> MediaDescriptor:
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self._extract, shortcode)
+
+    def _extract(self, shortcode: str) -> MediaDescriptor:
+        with yt_dlp.YoutubeDL(self.options) as ydl:
+            info = ydl.extract_info(f"https://www.instagram.com/p/{shortcode}/", download=False)
+        
+        entries = list(info.get("entries") or [info])
+        items = []
+        for i, entry in enumerate(entries, 1):
+            if entry.get("url") and entry.get("vcodec") != "none":
+                name = f"{i:02d}.mp4" if len(entries) > 1 else "video.mp4"
+                duration = entry.get("duration") if len(entries) == 1 else None
+                items.append(MediaItem(entry["url"], "video", name, duration))
+            elif entry.get("thumbnail"):
+                name = f"{i:02d}.jpg" if len(entries) > 1 else "photo.jpg"
+                items.append(MediaItem(entry["thumbnail"], "photo", name))
+        
+        if not items:
+            raise instaloader.exceptions.BadResponseException(f"yt-dlp: {shortcode} uchun media yo'q")
+        
+        caption = info.get("description") or entries[0].get("description") or ""
+        return MediaDescriptor(f"post:{shortcode}", caption, tuple(items))
+
+
+class HedgedExtractor:
+    """
+    Bir nechta backend bilan hedging
+    - Asosiy backend HEDGE_DELAY ichida javob bermasa yoki 429 / login (va boshqa
+      vaqtinchalik) xato bersa keyingisi ham ishga tushadi, birinchi natija olinadi
+    - Topilmadi / yopiq - aniq javob, boshqa backend so'ralmaydi
+    """
+
+    FINAL_ERRORS = tuple(PostCache.ERRORS.values())
+
+    def __init__(self, backends: list, delay: float):
+        self.backends = backends
+        self.delay = delay
+        self.hedged = 0
+        self.counters = {b.name: {"calls": 0, "wins": 0, "errors": 0, "seconds": 0.0} for b in backends}
+
+    async def _call(self, backend: Extractor, shortcode: str):
+        counters = self.counters[backend.name]
+        counters["calls"] += 1
+        started = time.perf_counter()
+        try:
+            return await backend.load_post(shortcode)
+        except Exception:
+            counters["errors"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            counters["seconds"] += elapsed
+            METRICS.observe("extractor_seconds", elapsed, backend=backend.name)
+
+    async def load_post(self, shortcode: str) -> MediaDescriptor:
+        pending = {}
+        first_error = None
+        waiting = list(self.backends)
+        
+        try:
+            while waiting or pending:
+                if waiting and not pending:
+                    if first_error is not None:
+                        self.hedged += 1
+                    backend = waiting.pop(0)
+                    pending[asyncio.ensure_future(self._call(backend, shortcode))] = backend
+                
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.delay if waiting else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                
+                if not done:
+                    # Asosiy sekin - keyingisini ham ishga tushirish
+                    self.hedged += 1
+                    backend = waiting.pop(0)
+                    pending[asyncio.ensure_future(self._call(backend, shortcode))] = backend
+                    continue
+                
+                for task in done:
+                    backend = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self.counters[backend.name]["wins"] += 1
+                        return task.result()
+                    if isinstance(error, self.FINAL_ERRORS):
+                        raise error
+                    print(f"Extractor {backend.name} failed for {shortcode}: {error!r}")
+                    first_error = first_error or error
+            
+            raise first_error
+        finally:
+            # Yutqazganlar natijasi kerak emas (thread o'zi tugaydi)
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "hedged": self.hedged,
+            **{
+                name: {
+                    "calls": c["calls"],
+                    "wins": c["wins"],
+                    "win_rate": c["wins"] / c["calls"] if c["calls"] else 0.0,
+                    "errors": c["errors"],
+                    "avg_ms": round(c["seconds"] / c["calls"] * 1000) if c["calls"] else 0,
+                }
+                for name, c in self.counters.items()
+            },
+        }
+
+
+def build_extractors():
+    available = {"instaloader": InstaloaderExtractor}
+    if yt_dlp:
+        available["yt-dlp"] = partial(YtDlpExtractor, YTDLP_COOKIES)
+    backends = [available[name]() for name in EXTRACTORS if name in available]
+    return backends or [InstaloaderExtractor()]
+
+
+EXTRACTOR = HedgedExtractor(build_extractors(), HEDGE_DELAY)
+
+
+async def resolve_post(shortcode: str) -> MediaDescriptor:
+    try:
+        desc = await EXTRACTOR.load_post(shortcode)
+    except Exception as e:
+        await POST_CACHE.put_error(shortcode, e)
+        raise
+    
+    await POST_CACHE.put(shortcode, desc)
+    return desc
+
+
+async def resolve_story(username: str, story_id):
+    return await load_story(username, story_id)
+
+
+# ================= LOOP LAG =================
+class LoopLagMonitor:
+    """
+    Event loop qotib qolishini kuzatish
+    - Har LOOP_LAG_INTERVAL da uyg'onadi, kechikish LOOP_LAG_WARN dan oshsa log yoziladi
+    - Loopda bloklovchi chaqiruv qaytib kelsa shu yerda ko'rinadi
+    """
+
+    def __init__(self, interval: float, warn: float):
+        self.interval = interval
+        self.warn = warn
+        self.task = None
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn:
+                self.stalls += 1
+                print(f"⚠️ Event loop lag: {lag * 1000:.0f} ms")
+
+    def stats(self):
+        return {"max_lag_ms": round(self.max_lag * 1000), "stalls": self.stalls}
+
+
+LOOP_MONITOR = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARN)
+
+
+# ================= METRICS =================
+class Metrics:
+    """
+    Prometheus formatidagi metrikalar (tashqi kutubxonasiz)
+    - Hot path'da faqat counter / histogram yangilanadi (dict + bisect)
+    - Kesh, navbat, ffmpeg kabi ko'rsatkichlar so'ralganda komponentlarning stats() dan olinadi
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.counters = {}  # (name, labels) -> qiymat
+        self.histograms = {}  # (name, labels) -> [bucket sonlari..., +Inf, summa]
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    @contextmanager
+    def span(self, stage: str):
+        """Bosqich vaqti (stage_seconds) va xatolar turi bo'yicha (errors_total)"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc("errors_total", stage=stage, type=type(e).__name__)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def summary(self, name: str):
+        """/stats uchun: label -> {count, avg, p95} (p95 bucket chegarasi bo'yicha)"""
+        result = {}
+        for (metric, labels), histogram in self.histograms.items():
+            if metric != name:
+                continue
+            count = sum(histogram[:-1])
+            cumulative = 0
+            p95 = float("inf")
+            for bound, n in zip(self.BUCKETS, histogram):
+                cumulative += n
+                if cumulative >= 0.95 * count:
+                    p95 = bound
+                    break
+            label = ",".join(str(v) for _, v in labels)
+            result[label] = {"count": count, "avg": histogram[-1] / count if count else 0.0, "p95": p95}
+        return result
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in labels)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+    def render(self, components: dict) -> str:
+        """Prometheus text format (har bir metrikaning qatorlari bitta blokda)"""
+        families = {}  # nom -> (tur, qatorlar)
+        
+        def family(name, kind):
+            return families.setdefault(name, (kind, []))[1]
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            full = f"{self.prefix}_{name}"
+            family(full, "counter").append(f"{full}{self._format_labels(labels)} {value}")
+        
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            full = f"{self.prefix}_{name}"
+            lines = family(full, "histogram")
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += n
+                lines.append(f"{full}_bucket{self._format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{full}_sum{self._format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{full}_count{self._format_labels(labels)} {cumulative}")
+        
+        # Komponentlar holati: ichma-ich dict bo'lsa tashqi kalit "key" label bo'ladi
+        for component, stats in components.items():
+            for key, value in stats.items():
+                fields = value.items() if isinstance(value, dict) else [(key, value)]
+                labels = (("key", key),) if isinstance(value, dict) else ()
+                for field, v in fields:
+                    if isinstance(v, (int, float)):
+                        full = f"{self.prefix}_{component}_{field}"
+                        family(full, "gauge").append(f"{full}{self._format_labels(labels)} {float(v)}")
+        
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics("eclipse")
+
+
+# ================= VIDEO COMPRESSION =================
+@cache
+def ffmpeg_capabilities():
+    """ffmpeg/ffprobe mavjudligi (bir marta tekshiriladi)"""
+    caps = {}
+    for tool in ("ffmpeg", "ffprobe"):
+        try:
+            subprocess.run([tool, '-version'], 
+                          stdout=subprocess.PIPE, 
+                          stderr=subprocess.PIPE, 
+                          check=True)
+            caps[tool] = True
+        except:
+            caps[tool] = False
+    return caps
+
+
+def check_ffmpeg():
+    """FFmpeg o'rnatilganligini tekshirish"""
+    return ffmpeg_capabilities()["ffmpeg"]
+
+
+class Transcoder:
+    """
+    ffmpeg/ffprobe jarayonlarini boshqarish
+    - Parallel encode soni "transcode" bosqichi workerlari bilan cheklanadi
+    - Har bir encode uchun -threads va past prioritet (nice) - bot qotib qolmaydi
+    - Job bekor qilinsa (timeout) jarayon o'ldiriladi va chala fayl o'chiriladi
+    """
+
+    def __init__(self, threads: int, nice: int):
+        self.threads = threads
+        self.nice = nice
+        self.running = 0
+        self.encodes = 0
+        self.cancelled = 0
+        self.encode_seconds = 0.0
+        self.media_seconds = 0.0
+
+    async def _spawn(self, cmd: list, **kwargs):
+        """
+        Jarayonni past prioritet bilan ishga tushirish
+        
+        preexec_fn ishlatilmaydi: threadlar bor protsessda xavfli va har safar to'liq fork qiladi.
+        nice jarayon ishga tushgan zahoti o'rnatiladi
+        """
+        if os.name == "nt":
+            kwargs["creationflags"] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+        if self.nice and os.name != "nt":
+            try:
+                os.setpriority(os.PRIO_PROCESS, process.pid, self.nice)
+            except OSError:
+                pass  # jarayon allaqachon tugagan
+        return process
+
+    async def run(self, cmd: list, output_path: Path = None):
+        """Jarayonni ishga tushirish -> (returncode, stdout, stderr)"""
+        process = await self._spawn(
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.running += 1
+        try:
+            stdout, stderr = await process.communicate()
+            return process.returncode, stdout, stderr
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if output_path:
+                output_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self.running -= 1
+
+    async def feed(self, cmd: list, chunks, output_path: Path = None):
+        """Jarayon stdin iga chunklarni berish (stream encode) -> returncode"""
+        process = await self._spawn(
+            cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.running += 1
+        try:
+            try:
+                async for chunk in chunks:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg xato bilan chiqdi - returncode orqali ko'rinadi
+                pass
+            return await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if output_path:
+                output_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self.running -= 1
+
+    def record(self, name: str, elapsed: float, duration: float):
+        """Encode vaqti va realtime factor"""
+        self.encodes += 1
+        self.encode_seconds += elapsed
+        self.media_seconds += duration
+        if duration:
+            print(f"Encode {name}: {elapsed:.1f}s, {duration / elapsed:.2f}x realtime")
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "encodes": self.encodes,
+            "cancelled": self.cancelled,
+            "encode_seconds": round(self.encode_seconds, 1),
+            "realtime_factor": self.media_seconds / self.encode_seconds if self.encode_seconds else 0.0,
+        }
+
+
+TRANSCODER = Transcoder(FFMPEG_THREADS, FFMPEG_NICE)
+
+
+async def probe_video(input_path: Path):
+    """
+    ffprobe orqali video ma'lumotlari
+    
+    Natija: {"duration", "width", "height", "fps", "bit_rate"} yoki None
+    """
+    probe_cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'format=duration,bit_rate:stream=width,height,avg_frame_rate,r_frame_rate',
+        '-of', 'json',
+        str(input_path)
+    ]
+    
+    if not (await asyncio.to_thread(ffmpeg_capabilities))["ffprobe"]:
+        return None
+    
+    try:
+        _, stdout, _ = await TRANSCODER.run(probe_cmd)
+        data = json.loads(stdout or b"{}")
+        
+        stream = (data.get("streams") or [{}])[0]
+        fmt = data.get("format", {})
+        duration = float(fmt.get("duration") or 0)
+        if duration <= 0:
+            return None
+        
+        fps = 30.0
+        for key in ("avg_frame_rate", "r_frame_rate"):
+            num, _, den = (stream.get(key) or "0/0").partition("/")
+            if float(num or 0) > 0 and float(den or 1) > 0:
+                fps = float(num) / float(den or 1)
+                break
+        
+        return {
+            "duration": duration,
+            "width": int(stream.get("width") or 0),
+            "height": int(stream.get("height") or 0),
+            "fps": fps,
+            "bit_rate": int(fmt.get("bit_rate") or 0),
+        }
+    except Exception as e:
+        print(f"Probe error: {e}")
+        return None
+
+
+def plan_encode(info: dict, target_size: int):
+    """
+    Target hajmga bitta o'tishda sig'adigan encode parametrlari
+    
+    - VBV: maxrate * (duration + VBV_SECONDS) <= budget, shuning uchun fayl albatta sig'adi
+    - Resolution: 720p/540p/480p dan bits-per-pixel yetarli bo'lgan eng kattasi
+    """
+    duration = info["duration"]
+    total_bps = target_size * 8 * (1 - MUX_OVERHEAD) / duration
+    
+    # Uzun videolarda audio ham kamaytiriladi
+    audio_bps = 128_000 if total_bps >= 1_000_000 else 64_000
+    
+    maxrate = (total_bps - audio_bps) * duration / (duration + VBV_SECONDS)
+    maxrate = max(int(maxrate), MIN_VIDEO_BITRATE)
+    bitrate = int(maxrate * 0.9)
+    
+    # Manba bitrate'idan oshirish foydasiz
+    if info["bit_rate"]:
+        source_video = info["bit_rate"] - audio_bps
+        if 0 < source_video < bitrate:
+            bitrate = source_video
+    
+    width, height = info["width"], info["height"]
+    # O'lcham noma'lum bo'lsa (stream) - oddiy reel (1080x1920) deb hisoblanadi
+    short, long = (min(width, height), max(width, height)) if width and height else (1080, 1920)
+    
+    rungs = [r for r in RESOLUTION_LADDER if r <= short] or [short]
+    target_short = rungs[-1]
+    for rung in rungs:
+        pixels = rung * (rung * long / short)
+        if bitrate / (pixels * info["fps"]) >= MIN_BITS_PER_PIXEL:
+            target_short = rung
+            break
+    
+    scale = None
+    if not (width and height):
+        # Orientatsiyadan qat'i nazar qisqa tomonni cheklash
+        scale = (
+            f"scale='if(gt(iw,ih),-2,min({target_short},iw))'"
+            f":'if(gt(iw,ih),min({target_short},ih),-2)'"
+        )
+    elif target_short < short:
+        scale = f"scale={target_short}:-2" if height > width else f"scale=-2:{target_short}"
+    
+    return {
+        "bitrate": bitrate,
+        "maxrate": maxrate,
+        "bufsize": int(maxrate * VBV_SECONDS),
+        "audio_bitrate": audio_bps,
+        "scale": scale,
+    }
+
+
+def encode_args(plan: dict):
+    """plan_encode natijasidan ffmpeg argumentlari -> (video_args, audio_bitrate)"""
+    video_args = [
+        '-b:v', str(plan["bitrate"]),
+        '-maxrate', str(plan["maxrate"]),
+        '-bufsize', str(plan["bufsize"]),
+    ]
+    if plan["scale"]:
+        video_args += ['-vf', plan["scale"]]
+    return video_args, str(plan["audio_bitrate"])
+
+
+async def compress_video(input_path: Path, output_path: Path, target_size: int):
+    """
+    Videoni compress qilish (low-end laptop uchun optimallashtirilgan)
+    
+    Strategy:
+    - ffprobe dagi davomiylik bo'yicha bitrate hisoblanadi - bitta encode
+    - VBV (maxrate/bufsize) bilan hajm target'dan oshmaydi
+    - Resolution bits-per-pixel bo'yicha tanlanadi (720p/540p/480p)
+    """
+    try:
+        # Video ma'lumotlarini olish
+        info = await probe_video(input_path)
+        
+        if info:
+            video_args, audio_bitrate = encode_args(plan_encode(info, target_size))
+        else:
+            # Davomiylik noma'lum - CRF usuli (hajm kafolatlanmaydi)
+            video_args = ['-crf', '28', '-vf', 'scale=-2:720']
+            audio_bitrate = '128k'
+        
+        compress_cmd = [
+            'ffmpeg', '-i', str(input_path),
+            '-c:v', 'libx264',  # H.264 codec
+            *video_args,
+            '-preset', 'veryfast',  # Low-end laptop uchun
+            '-threads', str(TRANSCODER.threads),  # CPU limiti
+            '-c:a', 'aac',  # Audio codec
+            '-b:a', audio_bitrate,  # Audio bitrate
+            '-movflags', '+faststart',  # Web uchun optimizatsiya
+            '-y',  # Overwrite
+            str(output_path)
+        ]
+        
+        started = time.monotonic()
+        await TRANSCODER.run(compress_cmd, output_path)
+        TRANSCODER.record(input_path.name, time.monotonic() - started, info["duration"] if info else 0)
+        
+        # Compress bo'lgan fayl hajmini tekshirish
+        return output_path.exists() and output_path.stat().st_size <= target_size
+        
+    except Exception as e:
+        print(f"Compress error: {e}")
+        return False
+
+
+async def can_stream_compress(content_length, duration) -> bool:
+    """Video yuklanayotganda to'g'ridan-to'g'ri ffmpeg ga berish mumkinmi"""
+    return bool(
+        STREAM_TRANSCODE
+        and duration
+        and content_length
+        and content_length > MAX_VIDEO_SIZE
+        and OVERSIZE_MODE in ("compress", "compress_split")
+        and await asyncio.to_thread(check_ffmpeg)
+    )
+
+
+async def stream_compress(chunks, output_path: Path, duration: float, size: int, target_size: int):
+    """
+    CDN dan kelayotgan baytlarni to'g'ridan-to'g'ri ffmpeg stdin ga berish
+    
+    - Yuklash va encode bir vaqtda ketadi, xom fayl diskka yozilmaydi
+    - Natija fragmented MP4 (stdin seek qilinmaydi)
+    - Davomiylik Instagram metadata'sidan olinadi (ffprobe yo'q)
+    """
+    info = {"duration": duration, "width": 0, "height": 0, "fps": 30.0, "bit_rate": int(size * 8 / duration)}
+    video_args, audio_bitrate = encode_args(plan_encode(info, target_size))
+    
+    stream_cmd = [
+        'ffmpeg', '-i', 'pipe:0',
+        '-c:v', 'libx264',
+        *video_args,
+        '-preset', 'veryfast',
+        '-threads', str(TRANSCODER.threads),
+        '-c:a', 'aac',
+        '-b:a', audio_bitrate,
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-f', 'mp4',
+        '-y',
+        str(output_path)
+    ]
+    
+    try:
+        started = time.monotonic()
+        returncode = await TRANSCODER.feed(stream_cmd, chunks, output_path)
+        
+        if returncode == 0 and output_path.exists() and output_path.stat().st_size <= target_size:
+            TRANSCODER.record(output_path.name, time.monotonic() - started, duration)
+            return True
+    except Exception as e:
+        print(f"Stream compress error: {e}")
+    
+    output_path.unlink(missing_ok=True)
+    return False
+
+
+async def split_video(input_path: Path, out_dir: Path, max_size: int):
+    """
+    Videoni qayta encode qilmasdan (stream copy) qismlarga bo'lish
+    
+    - Qismlar keyframe bo'yicha kesiladi, har biri max_size dan kichik
+    - Natija: tartiblangan fayllar ro'yxati (bo'lmasa [])
+    """
+    try:
+        info = await probe_video(input_path)
+        if not info:
+            return []
+        
+        parts = math.ceil(input_path.stat().st_size / (max_size * SPLIT_FILL))
+        out_dir.mkdir(exist_ok=True)
+        
+        # Keyframe'lar notekis bo'lsa qism hajmi oshib ketadi - unda ko'proq qism
+        while parts <= MAX_SPLIT_PARTS:
+            for old in out_dir.iterdir():
+                old.unlink()
+            
+            split_cmd = [
+                'ffmpeg', '-i', str(input_path),
+                '-map', '0:v:0', '-map', '0:a?',
+                '-c', 'copy',  # Encode yo'q
+                '-f', 'segment',
+                '-segment_time', f"{info['duration'] / parts:.3f}",
+                '-reset_timestamps', '1',
+                '-segment_format_options', 'movflags=+faststart',
+                '-y',
+                str(out_dir / "part_%02d.mp4")
+            ]
+            
+            await TRANSCODER.run(split_cmd)
+            
+            files = sorted(out_dir.glob("part_*.mp4"))
+            if files and all(f.stat().st_size <= max_size for f in files):
+                return files
+            parts += 1
+    
+    except Exception as e:
+        print(f"Split error: {e}")
+    
+    return []
+
+
+# ================= HTTP CLIENT =================
+class DownloadClient:
+    """
+    Barcha CDN yuklashlar uchun umumiy aiohttp session
+    - Bot ishlab turgan vaqt davomida bitta connection pool
+    - Keep-alive va DNS kesh - har bir linkda TCP/TLS handshake qilinmaydi
+    """
+
+    def __init__(self):
+        self.session = None
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.downloads = 0
+        self.ranged = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    async def start(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request)
+        trace.on_connection_create_end.append(self._on_create)
+        trace.on_connection_reuseconn.append(self._on_reuse)
+        
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=DOWNLOAD_TIMEOUT,
+                sock_connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT,
+            ),
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def get(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            await self.start()
+        return self.session
+
+    def record(self, size: int, elapsed: float, ranged: bool = False, retries: int = 0):
+        """Tugagan yuklash (throughput statistikasi uchun)"""
+        self.downloads += 1
+        self.ranged += ranged
+        self.retries += retries
+        self.bytes += size
+        self.seconds += elapsed
+
+    async def _on_request(self, session, ctx, params):
+        self.requests += 1
+
+    async def _on_create(self, session, ctx, params):
+        self.new_connections += 1
+
+    async def _on_reuse(self, session, ctx, params):
+        self.reused_connections += 1
+
+    def stats(self):
+        total = self.new_connections + self.reused_connections
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "reuse_rate": self.reused_connections / total if total else 0.0,
+            "downloads": self.downloads,
+            "ranged_downloads": self.ranged,
+            "range_retries": self.retries,
+            "bytes": self.bytes,
+            "throughput_mbps": self.bytes / 1048576 / self.seconds if self.seconds else 0.0,
+        }
+
+
+HTTP = DownloadClient()
+
+
+# ================= MEDIA STORE =================
+class MediaStore:
+    """
+    Yuklangan va compress qilingan fayllar keshi (diskda)
+    - Kalit: media id ("post:<shortcode>/01.mp4") + transform ("original", "compressed:<target>")
+    - Fayl nomi kalit hashidan olinadi, yozish atomik (vaqtinchalik fayl + rename)
+    - Umumiy hajm budjetdan oshsa eng kam ishlatilganlar o'chiriladi
+    - Jobga hardlink orqali beriladi: kesh tozalansa ham ishlayotgan job faylni yo'qotmaydi
+    - SQLite va fayl ishlari thread ichida; hajm xotirada yuritiladi, har RESYNC_EVERY yozuvda qayta hisoblanadi
+    """
+
+    RESYNC_EVERY = 100
+
+    def __init__(self, db_path: Path, root: Path, budget: int):
+        self.root = root
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.stores = 0
+        self.touched = {}  # digest -> last_used (hali yozilmagan)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            " digest TEXT PRIMARY KEY,"
+            " media_id TEXT NOT NULL,"
+            " transform TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS media_last_used ON media (last_used)")
+        self.db.commit()
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+        if budget:
+            root.mkdir(parents=True, exist_ok=True)
+            # Yiqilgan yozuvlardan qolgan vaqtinchalik fayllar. Boshqa workerlar ayni paytda
+            # yozayotgan bo'lishi mumkin - faqat job vaqtidan eski (ctime: hardlink ham yangilaydi)
+            cutoff = time.time() - JOB_TIMEOUT
+            for leftover in root.glob("*/*.tmp"):
+                try:
+                    if leftover.stat().st_ctime < cutoff:
+                        leftover.unlink(missing_ok=True)
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    @staticmethod
+    def _digest(media_id: str, transform: str) -> str:
+        return hashlib.sha256(f"{media_id}\0{transform}".encode()).hexdigest()
+
+    @staticmethod
+    def _link(src: Path, dst: Path):
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Boshqa disk yoki hardlink qo'llab-quvvatlanmaydi
+            shutil.copyfile(src, dst)
+
+    async def fetch(self, media_id: str, transform: str, dest: Path) -> bool:
+        """Keshdagi faylni dest ga joylash (bo'lmasa False)"""
+        if not self.budget:
+            return False
+        
+        digest = self._digest(media_id, transform)
+        if await asyncio.to_thread(self._fetch, digest, dest):
+            self.hits += 1
+            self.touched[digest] = time.time()
+            return True
+        self.misses += 1
+        return False
+
+    def _fetch(self, digest: str, dest: Path) -> bool:
+        with self.lock:
+            row = self.db.execute("SELECT size FROM media WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return False
+        
+        try:
+            self._link(self._path(digest), dest)
+        except FileNotFoundError:
+            # Fayl yo'q (qo'lda o'chirilgan) - yozuv ham keraksiz
+            with self.lock:
+                self.db.execute("DELETE FROM media WHERE digest = ?", (digest,))
+                self.db.commit()
+            return False
+        except OSError as e:
+            print(f"Media cache read error: {e}")
+            return False
+        return True
+
+    async def store(self, media_id: str, transform: str, src: Path):
+        """Faylni keshga qo'shish (atomik) va budjetdan oshganlarni o'chirish"""
+        size = src.stat().st_size
+        if not self.budget or size > self.budget:
+            return
+        
+        self.stores += 1
+        touched, self.touched = self.touched, {}
+        digest = self._digest(media_id, transform)
+        try:
+            await asyncio.to_thread(
+                self._store, digest, media_id, transform, src, size, touched,
+                self.stores % self.RESYNC_EVERY == 0
+            )
+        except OSError as e:
+            print(f"Media cache write error: {e}")
+
+    def _store(self, digest: str, media_id: str, transform: str, src: Path, size: int,
+               touched: dict, resync: bool):
+        path = self._path(digest)
+        tmp = path.with_name(f"{digest}.{os.getpid()}.{id(src)}.tmp")
+        path.parent.mkdir(exist_ok=True)
+        try:
+            self._link(src, tmp)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        
+        with self.lock:
+            self.db.executemany(
+                "UPDATE media SET last_used = ? WHERE digest = ?",
+                [(last_used, d) for d, last_used in touched.items()]
+            )
+            old = self.db.execute("SELECT size FROM media WHERE digest = ?", (digest,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO media (digest, media_id, transform, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (digest, media_id, transform, size, time.time())
+            )
+            self.db.commit()
+            self.total += size - (old[0] if old else 0)
+            # Boshqa workerlar ham yozadi: vaqti-vaqti bilan (va budjetdan oshganda) aniq yig'indi
+            if not resync and self.total <= self.budget:
+                return
+            self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+            victims = self._victims()
+        
+        # Fayllar lock dan tashqarida o'chiriladi
+        for victim in victims:
+            self._path(victim).unlink(missing_ok=True)
+
+    def _victims(self) -> list:
+        """Budjetdan oshgan qismni eng kam ishlatilganlardan o'chirish (lock ichida)"""
+        if self.total <= self.budget:
+            return []
+        
+        victims = []
+        for digest, size in self.db.execute("SELECT digest, size FROM media ORDER BY last_used"):
+            if self.total <= self.budget:
+                break
+            victims.append(digest)
+            self.total -= size
+        
+        self.db.executemany("DELETE FROM media WHERE digest = ?", [(d,) for d in victims])
+        self.db.commit()
+        self.evicted += len(victims)
+        return victims
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evicted": self.evicted,
+        }
+
+
+MEDIA_STORE = MediaStore(CACHE_DB, MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES)
+
+
+# ================= ASYNC DOWNLOAD =================
+async def download_range(session, url: str, path: Path, start: int, end: int, progress: dict):
+    """
+    [start, end] baytlarni faylning o'z joyiga yozish
+    
+    Ulanish uzilsa yoki qotib qolsa, yuklangan qism saqlanadi va qolgan joyidan davom etiladi
+    """
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    offset = start
+    attempt = 0
+    
+    with open(path, "r+b") as f:
+        while offset <= end:
+            before = offset
+            try:
+                async with session.get(url, headers={"Range": f"bytes={offset}-{end}"}, timeout=timeout) as response:
+                    if 400 <= response.status < 500 and response.status not in (408, 429):
+                        raise ValueError(f"HTTP {response.status}")
+                    response.raise_for_status()
+                    if response.status != 206:
+                        raise ValueError(f"Range qo'llab-quvvatlanmadi (HTTP {response.status})")
+                    f.seek(offset)
+                    async for chunk in response.content.iter_chunked(65536):
+                        chunk = chunk[:end + 1 - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if offset > end:
+                            break
+                if offset <= end:
+                    raise aiohttp.ClientPayloadError(f"{end + 1 - offset} bayt yetmadi")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt = 1 if offset > before else attempt + 1
+                if attempt > RANGE_RETRIES:
+                    raise
+                progress["retries"] += 1
+                delay = RANGE_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                print(f"Range {offset}-{end} retry {attempt} in {delay:.1f}s: {e!r}")
+                await asyncio.sleep(delay)
+
+
+async def ranged_download(url: str, path: Path, size: int) -> bool:
+    """Katta faylni RANGE_PARTS ta parallel Range so'rov bilan oldindan ajratilgan faylga yuklash"""
+    session = await HTTP.get()
+    step = math.ceil(size / RANGE_PARTS)
+    progress = {"retries": 0}
+    started = time.monotonic()
+    
+    with open(path, "wb") as f:
+        f.truncate(size)
+    
+    try:
+        async with asyncio.TaskGroup() as group:
+            for start in range(0, size, step):
+                group.create_task(download_range(session, url, path, start, min(start + step, size) - 1, progress))
+    except Exception as e:
+        print(f"Ranged download error for {url}: {e!r}")
+        return False
+    
+    elapsed = max(time.monotonic() - started, 1e-6)
+    HTTP.record(size, elapsed, ranged=True, retries=progress["retries"])
+    print(
+        f"⬇️ {path.name}: {size / 1048576:.1f}MB / {elapsed:.1f}s = {size / 1048576 / elapsed:.1f}MB/s "
+        f"({math.ceil(size / step)} qism, {progress['retries']} retry)"
+    )
+    return True
+
+
+async def download_file_async(url: str, path: Path, info: tuple = None):
+    """
+    Async ravishda fayl yuklash
+    
+    Katta videolar (RANGE_MIN_SIZE dan) Range so'rovlar bilan parallel yuklanadi.
+    info - oldindan olingan HEAD natijasi (size, accepts_ranges), bo'lmasa so'raladi
+    """
+    if path.suffix == ".mp4":
+        size, ranges = info or await remote_info(url)
+        if ranges and size and size >= RANGE_MIN_SIZE:
+            if await ranged_download(url, path, size):
+                return True
+    
+    try:
+        session = await HTTP.get()
+        timeout = aiohttp.ClientTimeout(
+            total=DOWNLOAD_TIMEOUT,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        )
+        async with session.get(url, timeout=timeout) as response:
+            if response.status != 200:
+                return False
+            started = time.monotonic()
+            with open(path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    f.write(chunk)
+            HTTP.record(path.stat().st_size, time.monotonic() - started)
+            return True
+    except Exception as e:
+        print(f"Download error for {url}: {e}")
+        return False
+
+
+async def stream_download(url: str, output_path: Path, duration: float) -> bool:
+    """Videoni CDN dan yuklash davomida ffmpeg ga uzatish (transcode bosqichida, natija output_path)"""
+    try:
+        session = await HTTP.get()
+        # Stream encode CDN tezligidan sekinroq bo'lishi mumkin - job timeout yetarli
+        timeout = aiohttp.ClientTimeout(
+            total=JOB_TIMEOUT,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        )
+        async with session.get(url, timeout=timeout) as response:
+            if response.status == 200 and response.content_length:
+                return await stream_compress(
+                    response.content.iter_chunked(65536),
+                    output_path,
+                    duration,
+                    response.content_length,
+                    TARGET_VIDEO_SIZE
+                )
+    except Exception as e:
+        print(f"Stream download error for {url}: {e}")
+    return False
+
+
+async def stream_item(key: str, item: MediaItem, tmp: Path):
+    """
+    Katta videoni yuklash + encode bitta transcode vazifasi sifatida
+    
+    Yo'l bosqichga kirishdan oldin tanlanadi (kesh, HEAD), shuning uchun uzun encode
+    download workerini band qilmaydi. Natija: (tayyormi, HEAD natijasi yoki None) -
+    tayyor bo'lmasa video download bosqichida oddiy yuklanadi
+    """
+    if not item.duration:
+        return False, None
+    
+    media_id = f"{key}/{item.filename}"
+    path = tmp / item.filename
+    encoded_path = path.with_suffix(".enc.mp4")
+    stream_transform = f"stream:{TARGET_VIDEO_SIZE}"
+    
+    if await MEDIA_STORE.fetch(media_id, stream_transform, encoded_path):
+        return True, None
+    # Original keshdan chiqib ketgan bo'lsa ham compress qilingan nusxa yetarli
+    # (.enc.mp4 nomi process_media ga tayyor ekanini bildiradi)
+    if await MEDIA_STORE.fetch(media_id, f"compressed:{TARGET_VIDEO_SIZE}", encoded_path):
+        if encoded_path.stat().st_size <= MAX_VIDEO_SIZE:
+            return True, None
+        encoded_path.unlink()
+    if await MEDIA_STORE.fetch(media_id, "original", path):
+        return True, None
+    
+    info = await remote_info(item.url)
+    if not await can_stream_compress(info[0], item.duration):
+        return False, info
+    
+    if await PIPELINE.run("transcode", lambda: stream_download(item.url, encoded_path, item.duration)):
+        await MEDIA_STORE.store(media_id, stream_transform, encoded_path)
+        return True, None
+    # Stream encode bo'lmadi - oddiy yuklash (keyin process_media hal qiladi)
+    return False, info
+
+
+async def download_item(key: str, item: MediaItem, tmp: Path, info: tuple = None):
+    """Bitta media: avval diskdagi keshdan, bo'lmasa CDN dan (natija keshga yoziladi)"""
+    media_id = f"{key}/{item.filename}"
+    path = tmp / item.filename
+    
+    if await MEDIA_STORE.fetch(media_id, "original", path):
+        return
+    
+    if await download_file_async(item.url, path, info):
+        await MEDIA_STORE.store(media_id, "original", path)
+
+
+async def download_media(key: str, items: tuple, tmp: Path):
+    """
+    Medialarni async yuklab olish
+    
+    Stream encode qilinadigan videolar transcode bosqichida, qolganlari bitta download vazifasida
+    """
+    routes = await asyncio.gather(*(stream_item(key, item, tmp) for item in items))
+    rest = [(item, info) for item, (done, info) in zip(items, routes) if not done]
+    if rest:
+        await PIPELINE.run("download", lambda: asyncio.gather(
+            *(download_item(key, item, tmp, info) for item, info in rest)
+        ))
+
+
+async def remote_info(url: str):
+    """HEAD so'rov: (fayl hajmi yoki None, Range qo'llab-quvvatlanadimi)"""
+    try:
+        session = await HTTP.get()
+        async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=15)) as response:
+            if response.status == 200:
+                return response.content_length, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except Exception as e:
+        print(f"HEAD error for {url}: {e}")
+    return None, False
+
+
+async def remote_size(url: str):
+    """HEAD so'rov orqali fayl hajmi (noma'lum bo'lsa None)"""
+    return (await remote_info(url))[0]
+
+
+async def url_media(items: tuple):
+    """
+    Telegram o'zi URL dan yuklay oladigan bo'lsa - media ro'yxati, aks holda None
+    
+    Bu holda server orqali yuklash va qayta yuklash umuman bo'lmaydi
+    """
+    if not URL_UPLOAD:
+        return None
+    
+    sizes = await asyncio.gather(*(remote_size(item.url) for item in items))
+    media = []
+    for item, size in zip(items, sizes):
+        limit = URL_PHOTO_LIMIT if item.type == "photo" else URL_VIDEO_LIMIT
+        if not size or size > limit:
+            return None
+        media.append({"url": item.url, "type": item.type, "size": size})
+    
+    return media
+
+
+# ================= PROCESS MEDIA =================
+async def process_media(tmp: Path, status_callback=None, key: str = None):
+    """
+    Yuklab olingan medialarni qayta ishlash va compress qilish
+    
+    key berilsa compress natijasi diskdagi keshdan olinadi / keshga yoziladi
+    """
+    media = []
+    has_ffmpeg = await asyncio.to_thread(check_ffmpeg)
+    
+    for f in sorted(tmp.iterdir()):
+        if not f.is_file():
+            continue
+        
+        size = f.stat().st_size
+        ext = f.suffix.lower()
+        
+        if ext in (".mp4", ".mov"):
+            # Video fayl
+            if size > MAX_VIDEO_SIZE:
+                if has_ffmpeg and OVERSIZE_MODE in ("compress", "compress_split"):
+                    # Compress qilish
+                    if status_callback:
+                        await status_callback("🔄 Video compress qilinmoqda...")
+                    
+                    compressed_path = tmp / f"compressed_{f.name}"
+                    media_id = f"{key}/{f.name}"
+                    transform = f"compressed:{TARGET_VIDEO_SIZE}"
+                    success = key is not None and await MEDIA_STORE.fetch(media_id, transform, compressed_path)
+                    if not success:
+                        success = await PIPELINE.run(
+                            "transcode",
+                            lambda: compress_video(f, compressed_path, TARGET_VIDEO_SIZE)
+                        )
+                        if success and key is not None and compressed_path.exists():
+                            await MEDIA_STORE.store(media_id, transform, compressed_path)
+                    
+                    if success and compressed_path.exists():
+                        compressed_size = compressed_path.stat().st_size
+                        if compressed_size <= MAX_VIDEO_SIZE:
+                            media.append({
+                                "path": str(compressed_path),
+                                "type": "video",
+                                "size": compressed_size,
+                                "compressed": True
+                            })
+                            continue
+                
+                if has_ffmpeg and OVERSIZE_MODE in ("split", "compress_split"):
+                    # Qismlarga bo'lish (encode yo'q, stream copy)
+                    if status_callback:
+                        await status_callback("✂️ Video qismlarga bo'linmoqda...")
+                    
+                    parts = await split_video(f, tmp / f"parts_{f.stem}", MAX_VIDEO_SIZE)
+                    for i, part in enumerate(parts, 1):
+                        media.append({
+                            "path": str(part),
+                            "type": "video",
+                            "size": part.stat().st_size,
+                            "compressed": False,
+                            "part": i,
+                            "parts": len(parts)
+                        })
+                    if parts:
+                        continue
+                
+                # Compress/split muvaffaqiyatsiz yoki FFmpeg yo'q
+                media.append({
+                    "path": str(f),
+                    "type": "too_large",
+                    "size": size
+                })
+            else:
+                # Kichik video yoki yuklash vaqtida compress qilingan (.enc.mp4)
+                media.append({
+                    "path": str(f),
+                    "type": "video",
+                    "size": size,
+                    "compressed": f.name.endswith(".enc.mp4")
+                })
+        
+        elif ext in (".jpg", ".jpeg", ".png", ".webp"):
+            # Rasm fayl
+            if size <= MAX_PHOTO_SIZE:
+                media.append({
+                    "path": str(f),
+                    "type": "photo",
+                    "size": size
+                })
+    
+    return media
+
+
+def clean_caption(text: str, max_length: int = 200) -> str:
+    """
+    Captionni tozalash va qisqartirish
+    - Hashtag va mentionlarni olib tashlash
+    - Emoji saqlab qolish
+    - Ko'p bo'sh joylarni tozalash
+    """
+    if not text:
+        return "📥 Instagram"
+    
+    # Hashtag va mentionlarni olib tashlash
+    text = re.sub(r'#\w+', '', text)
+    text = re.sub(r'@\w+', '', text)
+    
+    # Ko'p bo'sh joylarni tozalash
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\n\s*\n', '\n', text)
+    text = text.strip()
+    
+    # Bo'sh bo'lsa default caption
+    if not text or len(text) < 3:
+        return "📥 Instagram"
+    
+    # Uzunlikni cheklash
+    if len(text) > max_length:
+        text = text[:max_length].rsplit(' ', 1)[0] + "..."
+    
+    return f"📥 {text}"
+
+
+# ================= FILE_ID CACHE =================
+class FileIdCache:
+    """
+    Telegram qaytargan file_id larni saqlash (SQLite)
+    - Kalit: "post:<shortcode>" yoki "story:<mediaid>"
+    - TTL va hajm bo'yicha tozalash (eng kam ishlatilganlar o'chiriladi), har TRIM_EVERY yozuvda
+    - Yozish thread ichida; last_used yangilanishlari keyingi yozuv bilan birga diskka tushadi
+    """
+
+    TRIM_EVERY = 100
+
+    def __init__(self, path: Path, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.touched = {}  # key -> last_used (hali yozilmagan)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " key TEXT PRIMARY KEY,"
+            " items TEXT NOT NULL,"
+            " caption TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_created ON file_ids (created)")
+        self.db.commit()
+
+    def get(self, key: str):
+        """(items, caption) yoki None"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT items, caption FROM file_ids WHERE key = ? AND created > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touched[key] = now
+        return json.loads(row[0]), row[1]
+
+    async def put(self, key: str, items: list, caption: str):
+        self.puts += 1
+        touched, self.touched = self.touched, {}
+        await asyncio.to_thread(
+            self._write, key, json.dumps(items), caption, touched, self.puts % self.TRIM_EVERY == 0
+        )
+
+    def _write(self, key: str, items: str, caption: str, touched: dict, trim: bool):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "UPDATE file_ids SET last_used = ? WHERE key = ?",
+                [(last_used, k) for k, last_used in touched.items()]
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_ids (key, items, caption, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, items, caption, now, now)
+            )
+            if trim:
+                # Eskirganlarni va limitdan oshganlarni o'chirish (ikkalasi ham indeks bo'yicha)
+                self.db.execute("DELETE FROM file_ids WHERE created <= ?", (now - self.ttl,))
+                row = self.db.execute(
+                    "SELECT last_used FROM file_ids ORDER BY last_used DESC LIMIT 1 OFFSET ?",
+                    (self.max_entries,)
+                ).fetchone()
+                if row:
+                    self.db.execute("DELETE FROM file_ids WHERE last_used <= ?", row)
+            self.db.commit()
+
+    def delete(self, key: str):
+        self.touched.pop(key, None)
+        with self.lock:
+            self.db.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+            self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self.lock:
+            size = self.db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        return {
+            "entries": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+FILE_CACHE = FileIdCache(CACHE_DB, FILE_ID_CACHE_TTL, FILE_ID_CACHE_MAX)
+
+
+def message_file_id(message):
+    """Yuborilgan xabardan file_id olish"""
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id}
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    return None
+
+
+async def send_cached(update: Update, items: list, caption: str):
+    """Keshdagi file_id lar bilan bitta so'rovda yuborish"""
+    try:
+        if len(items) == 1:
+            item = items[0]
+            if item["type"] == "video":
+                await update.message.reply_video(
+                    video=item["file_id"],
+                    caption=caption,
+                    supports_streaming=True
+                )
+            else:
+                await update.message.reply_photo(photo=item["file_id"], caption=caption)
+        else:
+            for i, chunk in enumerate(media_groups(items)):
+                await send_group(update, chunk, caption if i == 0 else "")
+        return True
+    except Exception as e:
+        print(f"Cached send error: {e}")
+        return False
+
+
+# ================= SEND MEDIA =================
+def media_groups(media: list) -> list:
+    """
+    Media group'larga bo'lish (har birida 2-10 ta)
+    
+    Teng bo'linadi: 11 ta -> 6 + 5, oxirida bitta qolib ketmaydi
+    """
+    count = math.ceil(len(media) / 10)
+    size, extra = divmod(len(media), count)
+    groups = []
+    start = 0
+    for i in range(count):
+        end = start + size + (i < extra)
+        groups.append(media[start:end])
+        start = end
+    return groups
+
+
+async def flood_retry(send, attempts: int = 3):
+    """Bot API flood limiti (RetryAfter) bo'lsa ko'rsatilgan vaqt kutib qayta yuborish"""
+    for attempt in range(attempts):
+        try:
+            return await send()
+        except RetryAfter as e:
+            if attempt == attempts - 1:
+                raise
+            delay = e.retry_after
+            if not isinstance(delay, (int, float)):
+                delay = delay.total_seconds()
+            print(f"Flood limit, retry in {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def send_group(update: Update, items: list, caption: str):
+    """Bitta media group: fayl, URL yoki file_id"""
+    group = []
+    for i, item in enumerate(items):
+        if "file_id" in item:
+            f = item["file_id"]
+        elif "url" in item:
+            f = item["url"]
+        else:
+            f = Path(item["path"])
+        
+        cap = caption if i == 0 else ""
+        
+        if item["type"] == "video":
+            group.append(InputMediaVideo(media=f, caption=cap))
+        else:
+            group.append(InputMediaPhoto(media=f, caption=cap))
+    
+    return await flood_retry(lambda: update.message.reply_media_group(
+        media=group,
+        read_timeout=UPLOAD_TIMEOUT,
+        write_timeout=UPLOAD_TIMEOUT
+    ))
+
+
+class UrlSendError(Exception):
+    """URL orqali yuborish rad etildi; sent - undan oldin yuborilgan medialarning file_id lari"""
+
+    def __init__(self, error: Exception, sent: list):
+        super().__init__(str(error))
+        self.sent = sent
+
+
+async def send_media(update: Update, media: list, caption: str, sent: list = ()):
+    """
+    Medialarni Telegramga yuborish
+    
+    Muvaffaqiyatli bo'lsa {"items": [file_id...], "caption": ...} qaytaradi (kesh uchun)
+    URL orqali yuborishda xato bo'lsa UrlSendError chiqaradi (fayl bilan qayta urinish uchun).
+    sent - oldin yuborilgan birinchi medialar (ular qayta yuborilmaydi).
+    TimedOut bo'lsa Telegram faylni qabul qilgan bo'lishi mumkin - qayta yuborilmaydi, keshlanmaydi
+    """
+    if not media:
+        await update.message.reply_text("❌ Media topilmadi")
+        return None
+    
+    # Juda katta fayllar borligini tekshirish
+    too_large = [m for m in media if m["type"] == "too_large"]
+    if too_large:
+        total_size = sum(m["size"] for m in too_large) / (1024 * 1024)
+        
+        if not await asyncio.to_thread(check_ffmpeg):
+            await update.message.reply_text(
+                f"⚠️ Video juda katta ({total_size:.1f} MB)\n\n"
+                f"❗️ FFmpeg o'rnatilmagan, compress qilib bo'lmadi.\n\n"
+                f"Server adminiga xabar bering:\n"
+                f"`sudo apt install ffmpeg -y`"
+            )
+        else:
+            await update.message.reply_text(
+                f"⚠️ Video juda katta ({total_size:.1f} MB) va compress qilib bo'lmadi.\n"
+                f"Instagram'dan to'g'ridan-to'g'ri yuklab oling."
+            )
+        return None
+    
+    # Captionni tozalash
+    clean_cap = clean_caption(caption)
+    
+    # Qismlarga bo'lingan video haqida ma'lumot
+    parts = max((m.get("parts", 0) for m in media), default=0)
+    if parts:
+        clean_cap += f"\n\n✂️ Video {parts} qismga bo'lindi"
+    
+    # Bitta fayl bo'lsa
+    if len(media) == 1:
+        item = media[0]
+        
+        # Compress info qo'shish
+        if item.get("compressed"):
+            original_size = item["size"] / (1024 * 1024)
+            clean_cap += f"\n\n🔄 Compressed: {original_size:.1f} MB"
+        
+        by_url = "url" in item
+        try:
+            # Path - har bir urinishda fayl qaytadan o'qiladi
+            f = item["url"] if by_url else Path(item["path"])
+            if item["type"] == "video":
+                msg = await flood_retry(lambda: update.message.reply_video(
+                    video=f,
+                    caption=clean_cap,
+                    supports_streaming=True,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT
+                ))
+            else:
+                msg = await flood_retry(lambda: update.message.reply_photo(
+                    photo=f,
+                    caption=clean_cap,
+                    read_timeout=60,
+                    write_timeout=60
+                ))
+        except TimedOut as e:
+            print(f"Upload timed out, not resending: {e}")
+            return None
+        except Exception as e:
+            if by_url:
+                raise UrlSendError(e, []) from e
+            await update.message.reply_text(f"❌ Yuborishda xato: {str(e)[:100]}")
+            return None
+        
+        sent = message_file_id(msg)
+        return {"items": [sent], "caption": clean_cap} if sent else None
+    
+    # Ko'p fayl bo'lsa: 10 tadan media group, tartib bilan (caption birinchisida)
+    sent = list(sent)
+    rest = media[len(sent):]
+    try:
+        for chunk in media_groups(rest) if rest else []:
+            try:
+                messages = await send_group(update, chunk, "" if sent else clean_cap)
+            except TimedOut as e:
+                # Album yetib borgan bo'lishi mumkin - takrorlanmasin, keyingisiga o'tiladi
+                print(f"Media group timed out, not resending: {e}")
+                sent.extend([None] * len(chunk))
+                continue
+            sent.extend(message_file_id(m) for m in messages)
+        
+        if all(sent):
+            return {"items": sent, "caption": clean_cap}
+    
+    except Exception as e:
+        if any("url" in m for m in rest):
+            raise UrlSendError(e, sent) from e
+        await update.message.reply_text(f"❌ Media group yuborishda xato: {str(e)[:100]}")
+
+
+# ================= SCHEDULER =================
+class QueueFull(Exception):
+    """Navbat to'lgan - so'rov qabul qilinmaydi"""
+
+
+class JobScheduler:
+    """
+    Adolatli navbat (global DOWNLOAD_SEM o'rniga)
+    - Chatlar orasida round-robin: bitta foydalanuvchi 20 ta link tashlasa ham boshqalar kutib qolmaydi
+    - Har bir chat uchun parallel va navbatdagi joblar limiti
+    - Navbat to'lsa QueueFull
+    - Navbatdagi o'rin status orqali ko'rsatiladi
+    """
+
+    def __init__(self, max_active: int, max_queued: int, per_user_active: int, per_user_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.per_user_active = per_user_active
+        self.per_user_queued = per_user_queued
+        self.waiting = {}  # chat_id -> deque[entry]
+        self.order = deque()  # round-robin tartibi
+        self.active = {}  # chat_id -> ishlayotgan joblar soni
+        self.total_active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._notify_tasks = set()
+
+    def _can_start(self, chat_id) -> bool:
+        return (
+            self.total_active < self.max_active
+            and self.active.get(chat_id, 0) < self.per_user_active
+        )
+
+    def _take(self, chat_id):
+        self.total_active += 1
+        self.active[chat_id] = self.active.get(chat_id, 0) + 1
+
+    @asynccontextmanager
+    async def slot(self, chat_id, on_position=None):
+        """Navbatga turish va job uchun slot olish"""
+        if not self.queued and self._can_start(chat_id):
+            self._take(chat_id)
+        else:
+            queue = self.waiting.get(chat_id)
+            if self.queued >= self.max_queued or (queue and len(queue) >= self.per_user_queued):
+                self.rejected += 1
+                raise QueueFull()
+            
+            entry = {
+                "future": asyncio.get_running_loop().create_future(),
+                "notify": on_position,
+                "position": None,
+            }
+            if queue is None:
+                queue = self.waiting[chat_id] = deque()
+                self.order.append(chat_id)
+            queue.append(entry)
+            self.queued += 1
+            self._dispatch()
+            
+            try:
+                await entry["future"]
+            except asyncio.CancelledError:
+                if entry["future"].done() and not entry["future"].cancelled():
+                    # Slot berilgan edi - qaytarish
+                    self._release(chat_id)
+                else:
+                    self._remove(chat_id, entry)
+                raise
+        
+        try:
+            yield
+        finally:
+            self._release(chat_id)
+
+    def _remove(self, chat_id, entry):
+        queue = self.waiting.get(chat_id)
+        if queue and entry in queue:
+            queue.remove(entry)
+            self.queued -= 1
+            if not queue:
+                del self.waiting[chat_id]
+                self.order.remove(chat_id)
+        self._dispatch()
+
+    def _release(self, chat_id):
+        self.total_active -= 1
+        self.active[chat_id] -= 1
+        if not self.active[chat_id]:
+            del self.active[chat_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Bo'sh slotlarni chatlarga navbat bilan (round-robin) berish"""
+        while self.total_active < self.max_active:
+            for _ in range(len(self.order)):
+                chat_id = self.order[0]
+                self.order.rotate(-1)
+                if self._can_start(chat_id):
+                    queue = self.waiting[chat_id]
+                    entry = queue.popleft()
+                    self.queued -= 1
+                    if not queue:
+                        del self.waiting[chat_id]
+                        self.order.remove(chat_id)
+                    self._take(chat_id)
+                    entry["future"].set_result(None)
+                    break
+            else:
+                break
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Har bir kutayotgan jobga navbatdagi o'rnini yuborish"""
+        position = 0
+        depth = 0
+        pending = True
+        while pending:
+            pending = False
+            for chat_id in self.order:
+                queue = self.waiting[chat_id]
+                if depth >= len(queue):
+                    continue
+                pending = True
+                position += 1
+                entry = queue[depth]
+                if entry["notify"] and entry["position"] != position:
+                    entry["position"] = position
+                    task = asyncio.create_task(entry["notify"](f"⏳ Navbatdasiz: {position}-o'rin"))
+                    self._notify_tasks.add(task)
+                    task.add_done_callback(self._notify_tasks.discard)
+            depth += 1
+
+    def stats(self):
+        return {
+            "active": self.total_active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "chats_waiting": len(self.waiting),
+        }
+
+
+SCHEDULER = JobScheduler(MAX_ACTIVE_JOBS, QUEUE_MAX, PER_USER_ACTIVE, PER_USER_QUEUED)
+
+
+# ================= PIPELINE =================
+class Pipeline:
+    """
+    Bosqichma-bosqich ishlash: fetch -> download -> transcode -> upload
+    - Har bir bosqichning o'z bounded navbati va worker pooli bor
+    - Job faqat hozirgi bosqichning workerini band qiladi, shuning uchun
+      uzoq ffmpeg boshqa joblarning yuklanishi va yuborilishini to'xtatmaydi
+    """
+
+    def __init__(self, sizes: dict, queue_size: int):
+        self.sizes = sizes
+        self.queues = {name: asyncio.Queue(queue_size) for name in sizes}
+        self.busy = {name: 0 for name in sizes}
+        self.workers = []
+
+    def start(self):
+        for name, size in self.sizes.items():
+            for _ in range(size):
+                self.workers.append(asyncio.create_task(self._worker(name)))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def run(self, stage: str, fn):
+        """fn() ni berilgan bosqich workerida bajarish va natijani kutish"""
+        if not self.workers:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[stage].put((fn, future, time.perf_counter()))
+        return await future
+
+    async def _worker(self, stage: str):
+        queue = self.queues[stage]
+        while True:
+            fn, future, queued_at = await queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                
+                started = time.perf_counter()
+                METRICS.observe("stage_wait_seconds", started - queued_at, stage=stage)
+                self.busy[stage] += 1
+                task = asyncio.ensure_future(fn())
+                # Job bekor qilinsa bosqich ham to'xtaydi
+                future.add_done_callback(lambda f, t=task: f.cancelled() and t.cancel())
+                try:
+                    await asyncio.wait([task])
+                except asyncio.CancelledError:
+                    task.cancel()
+                    raise
+                finally:
+                    self.busy[stage] -= 1
+                    METRICS.observe("stage_seconds", time.perf_counter() - started, stage=stage)
+                
+                if not task.cancelled() and task.exception() is not None:
+                    METRICS.inc("errors_total", stage=stage, type=type(task.exception()).__name__)
+                if future.done():
+                    continue
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+            finally:
+                queue.task_done()
+
+    def stats(self):
+        return {
+            name: {"workers": self.sizes[name], "busy": self.busy[name], "queued": self.queues[name].qsize()}
+            for name in self.sizes
+        }
+
+
+PIPELINE = Pipeline(STAGE_LIMITS, STAGE_QUEUE_SIZE)
+
+
+# ================= IN-FLIGHT =================
+class InFlight:
+    """
+    Bir xil post uchun parallel so'rovlarni birlashtirish (single-flight)
+    - Birinchi so'rov yuklaydi, qolganlari shu natijani kutadi
+    - Har bir chat o'z status xabari va javobini oladi
+    - Oxirgi chat yuborib bo'lgach vaqtinchalik fayllar o'chiriladi
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.started = 0
+        self.joined = 0
+
+    @asynccontextmanager
+    async def join(self, key: str, fetch, status_callback):
+        job = self.jobs.get(key)
+        if job is None:
+            job = {"listeners": [], "refs": 0}
+
+            async def broadcast(text):
+                for callback in list(job["listeners"]):
+                    await callback(text)
+
+            def forget_failed(task):
+                # Xato bo'lsa keyingi so'rovlar qaytadan urinsin
+                if task.cancelled() or task.exception() is not None:
+                    if self.jobs.get(key) is job:
+                        del self.jobs[key]
+
+            job["task"] = asyncio.create_task(fetch(broadcast))
+            job["task"].add_done_callback(forget_failed)
+            self.jobs[key] = job
+            self.started += 1
         else:
-            await update.message.reply_text(
-                f"⚠️ Video juda katta ({total_size:.1f} MB) va compress qilib bo'lmadi.\n"
-                f"Instagram'dan to'g'ridan-to'g'ri yuklab oling."
+            self.joined += 1
+
+        job["listeners"].append(status_callback)
+        job["refs"] += 1
+        try:
+            result = await asyncio.shield(job["task"])
+            job["listeners"].remove(status_callback)
+            yield result
+        finally:
+            if status_callback in job["listeners"]:
+                job["listeners"].remove(status_callback)
+            job["refs"] -= 1
+            if job["refs"] == 0:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+                task = job["task"]
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    task.result()["tmpdir"].cleanup()
+
+    def stats(self):
+        return {"in_flight": len(self.jobs), "started": self.started, "joined": self.joined}
+
+
+IN_FLIGHT = InFlight()
+
+
+# ================= JOB QUEUE =================
+class JobQueue:
+    """
+    Protsesslar orasidagi doimiy navbat (SQLite/WAL)
+    - Front protsess update'larni yozadi, workerlar olib bajaradi
+    - Olingan job lease bilan band qilinadi, worker uni vaqti-vaqti bilan yangilaydi
+    - Worker yiqilsa (yoki qayta ishga tushsa) lease tugagach job boshqa workerga o'tadi
+    - Metodlar bloklaydi (busy timeout 30s) - event loopdan asyncio.to_thread orqali chaqiriladi
+    """
+
+    def __init__(self, path: Path, lease: int, max_attempts: int):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " updated REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+
+    def put(self, payload: dict, limit: int):
+        """Jobni navbatga yozish: navbatdagi o'rni, navbatda limit ta job bo'lsa None"""
+        with self.lock:
+            queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= limit:
+                return None
+            self.db.execute(
+                "INSERT INTO jobs (payload, status, updated) VALUES (?, 'queued', ?)",
+                (json.dumps(payload), time.time())
             )
-        return
+            return queued + 1
+
+    def claim(self, worker: str):
+        """Eng eski bo'sh (yoki lease'i tugagan) jobni olish: (id, payload, attempts) yoki None"""
+        with self.lock:
+            return self._claim(worker)
+
+    def _claim(self, worker: str):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT id, payload, attempts FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                    "lease_until = ?, updated = ? WHERE id = ?",
+                    (worker, now + self.lease, now, row[0])
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2] + 1
+
+    def renew(self, job_id: int, worker: str) -> bool:
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + self.lease, now, job_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: int, worker: str):
+        """Worker to'xtayapti - jobni urinish hisoblamasdan navbatga qaytarish"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker)
+            )
+
+    def finish(self, job_id: int, worker: str, ok: bool):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND worker = ?",
+                ("done" if ok else "failed", now, job_id, worker)
+            )
+            # Tugaganlar bir kun saqlanadi
+            self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (now - 86400,))
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("queued", "running", "done", "failed")}
+
+
+JOB_QUEUE = JobQueue(CACHE_DB, JOB_LEASE, JOB_MAX_ATTEMPTS)
+
+
+# ================= HANDLERS =================
+class UserError(Exception):
+    """Foydalanuvchiga to'g'ridan-to'g'ri ko'rsatiladigan xato"""
+
+
+async def fetch_post(shortcode: str, update_status) -> MediaDescriptor:
+    """Post yoki Reel ma'lumotlari"""
+    # Keshda bo'lsa Instagram'ga so'rov yo'q
+    desc = POST_CACHE.get(shortcode)
+    if desc:
+        return desc
     
-    # Captionni tozalash
-    clean_cap = clean_caption(caption)
+    await update_status("📥 Instagram'dan yuklanmoqda...")
     
-    # Bitta fayl bo'lsa
-    if len(media) == 1:
-        item = media[0]
-        
-        # Compress info qo'shish
-        if item.get("compressed"):
-            original_size = item["size"] / (1024 * 1024)
-            clean_cap += f"\n\n🔄 Compressed: {original_size:.1f} MB"
-        
-        try:
-            with open(item["path"], "rb") as f:
-                if item["type"] == "video":
-                    await update.message.reply_video(
-                        video=f,
-                        caption=clean_cap,
-                        supports_streaming=True,
-                        read_timeout=90,
-                        write_timeout=90
-                    )
-                else:
-                    await update.message.reply_photo(
-                        photo=f,
-                        caption=clean_cap,
-                        read_timeout=60,
-                        write_timeout=60
-                    )
-        except Exception as e:
-            await update.message.reply_text(f"❌ Yuborishda xato: {str(e)[:100]}")
-        return
+    return await PIPELINE.run("fetch", lambda: resolve_post(shortcode))
+
+
+async def fetch_story(username: str, story_id, update_status) -> MediaDescriptor:
+    """Story ma'lumotlari"""
+    await update_status("📥 Story yuklanmoqda...")
     
-    # Ko'p fayl bo'lsa (media group)
     try:
-        group = []
-        files_to_close = []
-        
-        for i, item in enumerate(media[:10]):  # Max 10 ta
-            f = open(item["path"], "rb")
-            files_to_close.append(f)
+        story = await PIPELINE.run("fetch", lambda: resolve_story(username, story_id))
+    except Exception:
+        raise UserError(
+            f"❌ Story yuklanmadi\n\n"
+            f"Story uchun Instagram login talab qilinishi mumkin.\n"
+            f".env faylida INSTAGRAM_USERNAME va INSTAGRAM_PASSWORD qo'shing"
+        )
+    
+    if not story:
+        raise UserError(
+            "❌ Story topilmadi\n\n"
+            "Sabablari:\n"
+            "• Story muddati tugagan (24 soat)\n"
+            "• Profil yopiq va siz follow qilmagansiz\n"
+            "• Instagram login kerak"
+        )
+    
+    return story
+
+
+POST_LINK = re.compile(r"(?:/p/|/reel/|/tv/)([A-Za-z0-9_-]+)")
+STORY_LINK = re.compile(r"/stories/([A-Za-z0-9._]+)/(\d+)")
+
+
+def link_keys(post_match, story_match):
+    """(file_id kesh kaliti yoki None, single-flight kaliti)"""
+    cache_key = None
+    if post_match:
+        cache_key = f"post:{post_match.group(1)}"
+    elif story_match.lastindex == 2:
+        cache_key = f"story:{story_match.group(2)}"
+    return cache_key, cache_key or f"story:{story_match.group(1)}"
+
+
+async def prepare_link(post_match, story_match, update_status):
+    """
+    Bitta link: ma'lumot + yuklash + qayta ishlash
+    
+    Natija: {"media", "caption", "cache_key", "items", "tmpdir"} - tmpdir ni InFlight tozalaydi
+    """
+    tmpdir = TemporaryDirectory(prefix="ig_", dir=WORK_DIR)
+    tmp = Path(tmpdir.name)
+    
+    try:
+        # Vaqt tugasa ffmpeg ham to'xtatiladi
+        async with asyncio.timeout(JOB_TIMEOUT):
+            if post_match:
+                desc = await fetch_post(post_match.group(1), update_status)
+            else:
+                username = story_match.group(1)
+                story_id = story_match.group(2) if story_match.lastindex == 2 else None
+                desc = await fetch_story(username, story_id, update_status)
             
-            cap = clean_cap if i == 0 else ""
+            # Kichik medialar - Telegram URL dan o'zi oladi
+            media = await url_media(desc.items)
             
-            if item["type"] == "video":
-                group.append(InputMediaVideo(media=f, caption=cap))
-            else:
-                group.append(InputMediaPhoto(media=f, caption=cap))
+            if media is None:
+                await download_media(desc.key, desc.items, tmp)
+                
+                # Medialarni qayta ishlash va compress qilish
+                media = await process_media(tmp, update_status, desc.key)
+    except BaseException:
+        tmpdir.cleanup()
+        raise
+    
+    return {"media": media, "caption": desc.caption, "cache_key": desc.key, "items": desc.items, "tmpdir": tmpdir}
+
+
+async def fetch_and_process(chat_id, post_match, story_match, update_status):
+    """Yuklash + qayta ishlash (barcha kutayotgan chatlar uchun bitta marta)"""
+    async with SCHEDULER.slot(chat_id, update_status):
+        return await prepare_link(post_match, story_match, update_status)
+
+
+async def download_fallback(result: dict, update_status):
+    """Telegram URL ni qabul qilmadi - fayllarni yuklab qayta ishlash (barcha chatlar uchun bir marta)"""
+    if "files" not in result:
+        async def download():
+            tmp = Path(result["tmpdir"].name)
+            await download_media(result["cache_key"], result["items"], tmp)
+            return await process_media(tmp, update_status, result["cache_key"])
         
-        if group:
-            await update.message.reply_media_group(
-                media=group,
-                read_timeout=90,
-                write_timeout=90
-            )
+        result["files"] = asyncio.ensure_future(download())
     
-    except Exception as e:
-        await update.message.reply_text(f"❌ Media group yuborishda xato: {str(e)[:100]}")
+    return await asyncio.shield(result["files"])
+
+
+async def deliver(update: Update, result: dict, update_status):
+    """Tayyor natijani yuborish (URL rad etilsa fayl bilan) va file_id larni keshlash"""
+    media = result["media"]
+    try:
+        sent = await PIPELINE.run("upload", lambda: send_media(update, media, result["caption"]))
+    except UrlSendError as e:
+        # URL rad etildi - oddiy yuklash va faqat yuborilmagan qismini yuborish
+        print(f"URL upload rejected: {e}")
+        files = await download_fallback(result, update_status)
+        # Fayllar URL medialarga mos kelsa (bo'linmagan) yuborilganlari o'tkazib yuboriladi
+        done = e.sent if len(files) == len(media) else []
+        media = files
+        sent = await PIPELINE.run("upload", lambda: send_media(update, media, result["caption"], done))
+    if sent:
+        METRICS.inc("upload_bytes_total", sum(m.get("size") or 0 for m in media if "path" in m))
+        await FILE_CACHE.put(result["cache_key"], sent["items"], sent["caption"])
+
+
+def error_message(e: Exception) -> str:
+    """Xato -> foydalanuvchiga ko'rsatiladigan matn"""
+    if isinstance(e, UserError):
+        return str(e)
+    if isinstance(e, QueueFull):
+        return (
+            "❌ Hozir navbat to'la yoki sizda juda ko'p so'rov kutmoqda.\n"
+            "Birozdan keyin qayta urinib ko'ring"
+        )
+    if isinstance(e, instaloader.exceptions.LoginRequiredException):
+        return (
+            "❌ Instagram login talab qiladi\n\n"
+            ".env faylida LOGIN va PASSWORD qo'shing"
+        )
+    if isinstance(e, instaloader.exceptions.PrivateProfileNotFollowedException):
+        return "❌ Bu profil yopiq"
+    if isinstance(e, instaloader.exceptions.QueryReturnedNotFoundException):
+        return "❌ Post topilmadi yoki o'chirilgan"
+    if isinstance(e, asyncio.TimeoutError):
+        return "❌ Yuklab olish vaqti tugadi. Qayta urinib ko'ring"
     
-    finally:
-        for f in files_to_close:
-            try:
-                f.close()
-            except:
-                pass
+    error_msg = str(e)
+    if "429" in error_msg or "rate limit" in error_msg.lower():
+        return "❌ Instagram chekladi. 10 daqiqa kutib qayta urinib ko'ring"
+    return f"❌ Xato: {error_msg[:150]}"
 
 
-# ================= HANDLERS =================
-DOWNLOAD_SEM = asyncio.Semaphore(2)
+async def handle_batch(update: Update, links: list):
+    """
+    Bir xabarda bir nechta link
+    - Hammasi bitta job (bitta scheduler slot) ichida yuklanadi, bir vaqtda ko'pi bilan
+      PER_USER_QUEUED ta - bitta xabardagi ko'p link umumiy bosqichlarni to'ldirib yubormaydi
+    - Natijalar link tartibida ketma-ket yuboriladi (keshdagilar ham) - javoblar aralashmaydi
+    """
+    chat_id = update.effective_chat.id
+    results = [None] * len(links)
+    ready = 0
+    
+    status_msg = await update.message.reply_text(f"⏳ {len(links)} ta link yuklanmoqda...")
+    
+    async def update_status(text):
+        try:
+            await status_msg.edit_text(text)
+        except:
+            pass
+    
+    async def quiet(text):
+        pass
+    
+    parallel = asyncio.Semaphore(PER_USER_QUEUED)
+    
+    async with AsyncExitStack() as stack:
+        async def prepare(i, post_match, story_match):
+            nonlocal ready
+            cache_key, flight_key = link_keys(post_match, story_match)
+            cached = FILE_CACHE.get(cache_key) if cache_key else None
+            try:
+                if cached:
+                    results[i] = ("cached", cached)
+                else:
+                    async with parallel:
+                        results[i] = ("result", await stack.enter_async_context(IN_FLIGHT.join(
+                            flight_key,
+                            lambda status: prepare_link(post_match, story_match, status),
+                            quiet
+                        )))
+            except Exception as e:
+                results[i] = ("error", e)
+            ready += 1
+            await update_status(f"⏳ {ready}/{len(links)} tayyor...")
+        
+        try:
+            with METRICS.span("batch"):
+                async with SCHEDULER.slot(chat_id, update_status):
+                    await asyncio.gather(*(prepare(i, *link) for i, link in enumerate(links)))
+        except QueueFull as e:
+            await update_status(error_message(e))
+            return
+        
+        await status_msg.delete()
+        
+        async def send(kind, value, post_match, story_match):
+            try:
+                if kind == "cached":
+                    if await send_cached(update, *value):
+                        return
+                    # file_id yaroqsiz - keshdan o'chirib linkni qaytadan yuklash
+                    cache_key, flight_key = link_keys(post_match, story_match)
+                    FILE_CACHE.delete(cache_key)
+                    kind, value = "result", await stack.enter_async_context(IN_FLIGHT.join(
+                        flight_key,
+                        lambda status: fetch_and_process(chat_id, post_match, story_match, status),
+                        quiet
+                    ))
+                if kind == "result":
+                    await deliver(update, value, quiet)
+                else:
+                    raise value
+            except Exception as e:
+                await update.message.reply_text(error_message(e))
+        
+        for result, link in zip(results, links):
+            await send(*result, *link)
 
 
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Instagram linkini qayta ishlash"""
     text = update.message.text.strip()
     
+    # Bir nechta link - bitta batch job
+    links = sorted(
+        [(m, None) for m in POST_LINK.finditer(text)] + [(None, m) for m in STORY_LINK.finditer(text)],
+        key=lambda link: (link[0] or link[1]).start()
+    )
+    unique = list({link_keys(*link)[1]: link for link in links}.values())
+    if len(unique) > 1:
+        await handle_batch(update, unique)
+        return
+    
     # Link formatini tekshirish
-    post_match = re.search(r"(?:/p/|/reel/|/tv/)([A-Za-z0-9_-]+)", text)
-    story_match = re.search(r"/stories/([A-Za-z0-9._]+)/(\d+)", text)
+    post_match = POST_LINK.search(text)
+    story_match = STORY_LINK.search(text)
     
     # Agar oddiy story link bo'lsa (username/story_id)
     if not story_match:
@@ -446,157 +3166,378 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    async with DOWNLOAD_SEM:
-        status_msg = await update.message.reply_text("⏳ Yuklanmoqda...")
-        
-        async def update_status(text):
-            try:
-                await status_msg.edit_text(text)
-            except:
-                pass
-        
-        tmpdir = TemporaryDirectory(prefix="ig_")
-        tmp = Path(tmpdir.name)
-        
+    # Oldin yuborilgan bo'lsa - file_id orqali bitta so'rovda qaytarish
+    cache_key, flight_key = link_keys(post_match, story_match)
+    
+    if cache_key:
+        cached = FILE_CACHE.get(cache_key)
+        if cached:
+            with METRICS.span("cached_send"):
+                sent = await send_cached(update, *cached)
+            if sent:
+                return
+            FILE_CACHE.delete(cache_key)
+    
+    status_msg = await update.message.reply_text("⏳ Yuklanmoqda...")
+    
+    async def update_status(text):
         try:
-            if post_match:
-                # Post yoki Reel
-                shortcode = post_match.group(1)
-                
-                await update_status("📥 Instagram'dan yuklanmoqda...")
-                
-                # Postni olish
-                post = await asyncio.to_thread(
-                    instaloader.Post.from_shortcode,
-                    L.context,
-                    shortcode
-                )
-                
-                # Medialarni yuklash
-                await download_post_media(post, tmp)
-                
-                # Caption
-                caption = post.caption or ""
-            
-            elif story_match:
-                # Story
-                username = story_match.group(1)
-                story_id = story_match.group(2)
-                
-                await update_status("📥 Story yuklanmoqda...")
-                
-                try:
-                    # Profile olish
-                    profile = await asyncio.to_thread(
-                        instaloader.Profile.from_username,
-                        L.context,
-                        username
-                    )
-                    
-                    # Barcha storylarni olish
-                    stories = await asyncio.to_thread(
-                        lambda: list(L.get_stories([profile.userid]))
-                    )
-                    
-                    story_item = None
-                    
-                    # Story ID bo'yicha qidirish
-                    for user_story in stories:
-                        for item in user_story.get_items():
-                            if str(item.mediaid) == story_id or story_id in str(item):
-                                story_item = item
-                                break
-                        if story_item:
-                            break
-                    
-                    # Agar ID topilmasa, eng yangi storyni olish
-                    if not story_item and stories:
-                        for user_story in stories:
-                            items = list(user_story.get_items())
-                            if items:
-                                story_item = items[0]
-                                break
-                    
-                    if not story_item:
-                        await status_msg.edit_text(
-                            "❌ Story topilmadi\n\n"
-                            "Sabablari:\n"
-                            "• Story muddati tugagan (24 soat)\n"
-                            "• Profil yopiq va siz follow qilmagansiz\n"
-                            "• Instagram login kerak"
-                        )
-                        return
-                    
-                    await download_story_media(story_item, tmp)
-                    caption = ""
-                    
-                except Exception as e:
-                    await status_msg.edit_text(
-                        f"❌ Story yuklanmadi\n\n"
-                        f"Story uchun Instagram login talab qilinishi mumkin.\n"
-                        f".env faylida INSTAGRAM_USERNAME va INSTAGRAM_PASSWORD qo'shing"
-                    )
-                    return
-            
-            # Medialarni qayta ishlash va compress qilish
-            media = await process_media(tmp, update_status)
-            
-            await update_status("📤 Telegram'ga yuborilmoqda...")
-            await status_msg.delete()
-            await send_media(update, media, caption)
-        
-        except instaloader.exceptions.LoginRequiredException:
-            await status_msg.edit_text(
-                "❌ Instagram login talab qiladi\n\n"
-                ".env faylida LOGIN va PASSWORD qo'shing"
-            )
-        
-        except instaloader.exceptions.PrivateProfileNotFollowedException:
-            await status_msg.edit_text("❌ Bu profil yopiq")
-        
-        except instaloader.exceptions.QueryReturnedNotFoundException:
-            await status_msg.edit_text("❌ Post topilmadi yoki o'chirilgan")
-        
-        except asyncio.TimeoutError:
-            await status_msg.edit_text("❌ Yuklab olish vaqti tugadi. Qayta urinib ko'ring")
-        
-        except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "rate limit" in error_msg.lower():
-                await status_msg.edit_text("❌ Instagram chekladi. 10 daqiqa kutib qayta urinib ko'ring")
-            else:
-                await status_msg.edit_text(f"❌ Xato: {error_msg[:150]}")
-        
-        finally:
-            tmpdir.cleanup()
+            await status_msg.edit_text(text)
+        except:
+            pass
+    
+    try:
+        # Bir xil linklar bitta yuklashni baham ko'radi
+        with METRICS.span("job"):
+            async with IN_FLIGHT.join(
+                flight_key,
+                lambda status: fetch_and_process(update.effective_chat.id, post_match, story_match, status),
+                update_status
+            ) as result:
+                await update_status("📤 Telegram'ga yuborilmoqda...")
+                await status_msg.delete()
+                await deliver(update, result, update_status)
+    
+    except Exception as e:
+        await status_msg.edit_text(error_message(e))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start komandasi"""
-    ffmpeg_status = "✅ O'rnatilgan" if check_ffmpeg() else "❌ O'rnatilmagan"
+    ffmpeg_status = "✅ O'rnatilgan" if await asyncio.to_thread(check_ffmpeg) else "❌ O'rnatilmagan"
     
     await update.message.reply_text(
         f"👋 Salom!\n\n"
         f"Instagram post, reel yoki story linkini yuboring.\n\n"
         f"📌 Imkoniyatlar:\n"
         f"• Post va carousel\n"
-        f"• Reel (50MB+ avtomatik compress)\n"
+        f"• Reel ({MAX_VIDEO_SIZE // 1048576}MB+ avtomatik compress)\n"
         f"• Story\n"
         f"• Toza caption (hashtag/mention siz)\n\n"
         f"🔧 FFmpeg: {ffmpeg_status}\n\n"
-        f"💡 50MB+ videolar avtomatik compress qilinadi"
+        f"💡 {MAX_VIDEO_SIZE // 1048576}MB+ videolar avtomatik compress qilinadi"
+    )
+
+
+def collect_stats():
+    """Barcha komponentlar holati (/stats va /metrics uchun)"""
+    return {
+        "scheduler": SCHEDULER.stats(),
+        "pipeline": PIPELINE.stats(),
+        "in_flight": IN_FLIGHT.stats(),
+        "jobs": JOB_QUEUE.stats(),
+        "http": HTTP.stats(),
+        "transcoder": TRANSCODER.stats(),
+        "file_cache": FILE_CACHE.stats(),
+        "media_store": MEDIA_STORE.stats(),
+        "post_cache": POST_CACHE.stats(),
+        "story_cache": STORY_CACHE.stats(),
+        "accounts": ACCOUNTS.stats(),
+        "extractors": EXTRACTOR.stats(),
+        "loop": LOOP_MONITOR.stats(),
+    }
+
+
+def rounded(value):
+    if isinstance(value, float):
+        return round(value, 3)
+    if isinstance(value, dict):
+        return {k: rounded(v) for k, v in value.items()}
+    return value
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin komandasi: bosqichlar kechikishi, xatolar va komponentlar holati"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    errors = {
+        ",".join(str(v) for _, v in labels): value
+        for (name, labels), value in METRICS.counters.items() if name == "errors_total"
+    }
+    report = {
+        "latency": METRICS.summary("stage_seconds"),
+        "wait": METRICS.summary("stage_wait_seconds"),
+        "errors": errors,
+        **collect_stats(),
+    }
+    text = json.dumps(rounded(report), indent=1, ensure_ascii=False)
+    await update.message.reply_text(text[:4000])
+
+
+async def metrics_handler(request):
+    return web.Response(
+        body=METRICS.render(collect_stats()).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server():
+    """Prometheus /metrics endpointi (METRICS_PORT berilgan bo'lsa)"""
+    if not METRICS_PORT:
+        return
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    METRICS_RUNNERS.append(runner)
+    print(f"📈 Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_metrics_server():
+    for runner in METRICS_RUNNERS:
+        await runner.cleanup()
+    METRICS_RUNNERS.clear()
+
+
+METRICS_RUNNERS = []
+
+
+async def session_health_loop():
+    """Instagram sessionlarini fonda tekshirish va yangilash (polling boshlangandan keyin)"""
+    while True:
+        for account in ACCOUNTS.accounts:
+            try:
+                ok = await run_insta(refresh_session, account)
+                print(f"🔑 Instagram {account.name}: {'✅ session OK' if ok else '⚠️ login yo‘q'}")
+            except Exception as e:
+                print(f"Session check error ({account.name}): {e}")
+        await asyncio.sleep(SESSION_CHECK_INTERVAL)
+
+
+async def session_reload_loop():
+    """
+    Worker: front protsess yangilagan session fayllarini qayta o'qish
+    
+    Login va tekshirish faqat front protsessda - bitta akkauntga N ta parallel login
+    va bitta session fayliga bir nechta protsess yozishi bo'lmaydi
+    """
+    seen = {}
+    while True:
+        for account in ACCOUNTS.accounts:
+            try:
+                mtime = account.session_file.stat().st_mtime
+            except OSError:
+                mtime = None
+            if account.name in seen and seen[account.name] == mtime:
+                continue
+            seen[account.name] = mtime
+            ok = mtime is not None and await run_insta(load_saved_session, account)
+            account.logged_in = ok
+            account.ready = ok or account is ACCOUNTS.accounts[0]
+        await asyncio.sleep(SESSION_RELOAD_INTERVAL)
+
+
+async def detect_ffmpeg():
+    caps = await asyncio.to_thread(ffmpeg_capabilities)
+    print(f"🔧 FFmpeg: {'✅ Mavjud' if caps['ffmpeg'] else '❌ O‘rnatilmagan'}"
+          f", ffprobe: {'✅' if caps['ffprobe'] else '❌'}")
+
+
+async def record_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Birinchi update kelgan vaqtni yozish (time-to-first-update)"""
+    global FIRST_UPDATE_AT
+    if FIRST_UPDATE_AT is None:
+        FIRST_UPDATE_AT = time.monotonic()
+        print(f"⏱ Birinchi update: {FIRST_UPDATE_AT - STARTED_AT:.2f}s")
+
+
+BACKGROUND_TASKS = []
+
+
+async def on_startup(app: Application):
+    """Application post_init: umumiy resurslarni ochish"""
+    await HTTP.start()
+    PIPELINE.start()
+    LOOP_MONITOR.start()
+    await start_metrics_server()
+    
+    # Tarmoq va subprocess ishlari fonda - polling kutib turmaydi.
+    # Worker rejimida (app yo'q) sessionlarni front protsess yangilaydi
+    ACCOUNTS.can_login = app is not None
+    sessions = session_health_loop() if app else session_reload_loop()
+    BACKGROUND_TASKS.append(asyncio.create_task(sessions))
+    BACKGROUND_TASKS.append(asyncio.create_task(detect_ffmpeg()))
+    print(f"⏱ Tayyor: {time.monotonic() - STARTED_AT:.2f}s")
+
+
+async def on_shutdown(app: Application):
+    """Application post_shutdown: resurslarni yopish"""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    await stop_metrics_server()
+    await LOOP_MONITOR.stop()
+    await PIPELINE.stop()
+    await HTTP.close()
+
+
+# ================= WORKERS =================
+async def enqueue_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Worker rejimi: xabarni navbatga yozish (yuklash va yuborishni worker bajaradi)
+    
+    Navbatda QUEUE_MAX ta job bo'lsa rad etiladi, aks holda darhol o'rni aytiladi
+    """
+    position = await asyncio.to_thread(JOB_QUEUE.put, update.to_dict(), QUEUE_MAX)
+    if position is None:
+        await update.message.reply_text(error_message(QueueFull()))
+        return
+    
+    # Linksiz xabarga javobni (yordam matni) worker beradi
+    text = update.message.text
+    if POST_LINK.search(text) or STORY_LINK.search(text):
+        await update.message.reply_text(f"⏳ Navbatdasiz: {position}-o'rin")
+
+
+async def run_job(bot: Bot, worker: str, job_id: int, payload: dict, attempts: int):
+    """Navbatdagi bitta jobni bajarish, lease'ni ish davomida yangilab turish"""
+    update = Update.de_json(payload, bot)
+    
+    if attempts > JOB_MAX_ATTEMPTS:
+        # Oldingi urinishlarda worker yiqilgan
+        await asyncio.to_thread(JOB_QUEUE.finish, job_id, worker, False)
+        try:
+            await update.message.reply_text("❌ So'rovni bajarib bo'lmadi. Linkni qayta yuboring")
+        except TelegramError:
+            pass
+        return
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            if not await asyncio.to_thread(JOB_QUEUE.renew, job_id, worker):
+                print(f"Job {job_id}: lease lost")
+    
+    beat = asyncio.create_task(heartbeat())
+    try:
+        await handle_link(update, None)
+    except asyncio.CancelledError:
+        beat.cancel()
+        await asyncio.to_thread(JOB_QUEUE.release, job_id, worker)
+        raise
+    except Exception as e:
+        print(f"Job {job_id} error: {e!r}")
+        ok = False
+    else:
+        ok = True
+    finally:
+        beat.cancel()
+    await asyncio.to_thread(JOB_QUEUE.finish, job_id, worker, ok)
+
+
+async def worker_loop(name: str):
+    """Worker protsess: navbatdan job olish va pipeline orqali bajarish"""
+    # Ortig'i navbatda qoladi - bo'sh workerlar olsin
+    slots = asyncio.Semaphore(MAX_ACTIVE_JOBS)
+    tasks = set()
+    
+    def done(task):
+        tasks.discard(task)
+        slots.release()
+    
+    async with Bot(BOT_TOKEN, **BOT_API_KWARGS) as bot:
+        await on_startup(None)
+        print(f"👷 {name} ishga tushdi")
+        try:
+            while True:
+                await slots.acquire()
+                job = await asyncio.to_thread(JOB_QUEUE.claim, name)
+                if job is None:
+                    slots.release()
+                    await asyncio.sleep(JOB_POLL)
+                    continue
+                task = asyncio.create_task(run_job(bot, name, *job))
+                tasks.add(task)
+                task.add_done_callback(done)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await on_shutdown(None)
+
+
+def worker_main(index: int):
+    """multiprocessing entry point"""
+    # SIGTERM ham Ctrl+C kabi: joblar bekor qilinib navbatga qaytariladi
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index
+    try:
+        asyncio.run(worker_loop(f"worker-{index}-{os.getpid()}"))
+    except KeyboardInterrupt:
+        pass
+
+
+WORKER_PROCESSES = {}
+
+
+def spawn_worker(index: int):
+    process = multiprocessing.get_context("spawn").Process(
+        target=worker_main, args=(index,), name=f"worker-{index}"
     )
+    process.start()
+    WORKER_PROCESSES[index] = process
+
+
+async def supervise_workers():
+    """Yiqilgan workerlarni qayta ishga tushirish (ularning joblari lease tugagach qayta olinadi)"""
+    while True:
+        await asyncio.sleep(5)
+        for index, process in list(WORKER_PROCESSES.items()):
+            if not process.is_alive():
+                print(f"Worker {index} exited ({process.exitcode}), restarting")
+                spawn_worker(index)
+
+
+async def on_front_startup(app: Application):
+    """Worker rejimi post_init: worker protsesslarni ishga tushirish"""
+    for index in range(WORKERS):
+        spawn_worker(index)
+    BACKGROUND_TASKS.append(asyncio.create_task(supervise_workers()))
+    BACKGROUND_TASKS.append(asyncio.create_task(session_health_loop()))
+    await start_metrics_server()
+    print(f"⏱ Tayyor: {time.monotonic() - STARTED_AT:.2f}s, {WORKERS} worker")
+
+
+async def on_front_shutdown(app: Application):
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    await stop_metrics_server()
+    for process in WORKER_PROCESSES.values():
+        process.terminate()
+    for process in WORKER_PROCESSES.values():
+        await asyncio.to_thread(process.join, 10)
 
 
 def main():
     """Botni ishga tushirish"""
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(on_front_startup if WORKERS else on_startup)
+        .post_shutdown(on_front_shutdown if WORKERS else on_shutdown)
+    )
+    if LOCAL_BOT_API:
+        builder = (
+            builder
+            .base_url(BOT_API_KWARGS["base_url"])
+            .base_file_url(BOT_API_KWARGS["base_file_url"])
+            .local_mode(True)
+        )
+    app = builder.build()
     
+    app.add_handler(TypeHandler(Update, record_first_update), group=-1)
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, enqueue_link if WORKERS else handle_link))
     
     print("🤖 Bot ishga tushdi...")
-    print(f"🔧 FFmpeg: {'✅ Mavjud' if check_ffmpeg() else '❌ O\'rnatilmagan'}")
+    if LOCAL_BOT_API:
+        print(f"📡 Lokal Bot API: {BOT_API_URL} (video limit {MAX_VIDEO_SIZE // 1048576}MB)")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 